@@ -20,9 +20,10 @@ sys.path.append(PATH)
 from lib.utilities_contour import get_contours_from_annotations, create_volume
 from lib.sqlcontroller import SqlController
 from lib.file_location import DATA_PATH, FileLocationManager
-from lib.utilities_alignment import parse_elastix, transform_create_alignment, create_warp_transforms
+from lib.utilities_alignment import transform_create_alignment
+from lib.utilities_transform_stack import load_transform_stack, scale_translations
 from lib.utilities_atlas import ATLAS
-from abakit.utilities.shell_tools import get_image_size
+from lib.utilities_process import get_image_size
 
 
 DOWNSAMPLE_FACTOR = 32
@@ -90,15 +91,9 @@ def create_volumes(animal, create):
 
     section_offset = create_clean_transform(animal)
 
-    transforms = parse_elastix(animal)
-    warp_transforms = create_warp_transforms(animal, transforms, downsample=False)
-    ordered_transforms = sorted(warp_transforms.items())
-
-    section_transform = {}
-    for section, transform in ordered_transforms:
-        section_num = int(section.split('.')[0])
-        transform = np.linalg.inv(transform)
-        section_transform[section_num] = transform
+    files, transforms = load_transform_stack(animal)
+    inverses = np.linalg.inv(scale_translations(transforms, downsample=False))
+    section_transform = {int(file.split('.')[0]): transform for file, transform in zip(files, inverses)}
 
     aligned_section_structure_polygons = defaultdict(dict)
     for section in section_structure_vertices:
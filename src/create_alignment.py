@@ -11,7 +11,6 @@ import argparse
 import numpy as np
 import pandas as pd
 from collections import OrderedDict
-from concurrent.futures.process import ProcessPoolExecutor
 from timeit import default_timer as timer
 
 from PIL import Image
@@ -20,7 +19,7 @@ Image.MAX_IMAGE_PIXELS = None
 from lib.file_location import FileLocationManager
 from lib.sqlcontroller import SqlController
 from lib.utilities_alignment import (create_warp_transforms,   parse_elastix, process_image)
-from lib.utilities_process import test_dir, get_cpus
+from lib.utilities_process import test_dir, get_cpus, get_task_memory, run_memory_bounded, SCALING_FACTOR
 
 
 def run_offsets(animal, transforms, channel, downsample, masks, create_csv, allen,njobs):
@@ -30,7 +29,7 @@ def run_offsets(animal, transforms, channel, downsample, masks, create_csv, alle
     Args:
         animal: the animal
         transforms: the dictionary of file, coordinates
-        limit: number of jobs
+        njobs: most processes to run, fewer run at once when the sections do not fit in memory
     Returns: nothing
     """
     fileLocationManager = FileLocationManager(animal)
@@ -88,9 +87,14 @@ def run_offsets(animal, transforms, channel, downsample, masks, create_csv, alle
     else:
         start = timer()
         # workers, _ = get_cpus()
-        print(f'Working on {len(file_keys)} files with {njobs} cpus')
-        with ProcessPoolExecutor(max_workers=njobs) as executor:
-            executor.map(process_image, sorted(file_keys))
+        width = sqlController.scan_run.width
+        height = sqlController.scan_run.height
+        if downsample:
+            width, height = int(width * SCALING_FACTOR), int(height * SCALING_FACTOR)
+        # PIL holds the input and the transformed image
+        memory = [get_task_memory(width, height, copies=2)] * len(file_keys)
+        print(f'Working on {len(file_keys)} files with up to {njobs} cpus')
+        run_memory_bounded(process_image, sorted(file_keys), memory, njobs)
 
         end = timer()
         print(f'Create cleaned files took {end - start} seconds total', end="\t")
@@ -106,8 +110,9 @@ def run_offsets(animal, transforms, channel, downsample, masks, create_csv, alle
 
 def create_csv_data(animal, file_keys):
     data = []
-    for index, infile, outfile, T in file_keys:
-        T = np.linalg.inv(T)
+    # all the sections are inverted at once
+    inverses = np.linalg.inv(np.array([T for _, _, _, T in file_keys]).reshape(-1, 3, 3))
+    for (index, infile, outfile, _), T in zip(file_keys, inverses):
         file = os.path.basename(infile)
 
         data.append({
@@ -134,7 +139,7 @@ if __name__ == '__main__':
     parser.add_argument('--csv', help='Enter true or false', required=False, default='false')
     parser.add_argument('--allen', help='Enter true or false', required=False, default='false')
     parser.add_argument('--scale', help='Enter scaling', required=False, default=45000)
-    parser.add_argument('--njobs', help='number of core to use for parallel processing muralus can handle 20-25 ratto can handle 4', required=False, default=4)
+    parser.add_argument('--njobs', help='most cores to use, fewer are used when the sections do not fit in memory', required=False, default=4)
 
 
     args = parser.parse_args()
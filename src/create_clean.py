@@ -4,7 +4,10 @@ on channel 1. It also does the rotating and flip/flop if necessary.
 On channel one it scales and does an adaptive histogram equalization.
 Note, the scaled method takes 45000 as the default. This is usually
 a good value for 16bit images. Note, opencv uses lzw compression by default
-to save files.
+to save files. With --tiled true, full resolution sections are cleaned a block at a time
+with lib/utilities_clean.py and saved as tiled, deflate compressed tifs. With --align true
+they are also aligned in the same pass and written straight to full_aligned, see
+lib/utilities_geometry.py.
 """
 import argparse
 import os, sys
@@ -12,15 +15,26 @@ import cv2
 import numpy as np
 from skimage import io
 from tqdm import tqdm
-from concurrent.futures.process import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from timeit import default_timer as timer
 from sql_setup import CLEAN_CHANNEL_1_THUMBNAIL_WITH_MASK
 from lib.file_location import FileLocationManager
 from lib.sqlcontroller import SqlController
 from lib.utilities_mask import rotate_image, place_image, scaled, equalized
-from lib.utilities_process import test_dir, SCALING_FACTOR
+from lib.utilities_process import test_dir, SCALING_FACTOR, get_task_memory, run_memory_bounded, TASK_OVERHEAD
+from lib.utilities_manifest import load_manifest, read_image_header
+from lib.utilities_virtual_mask import VirtualMask, apply_mask
+from lib.utilities_packed_mask import load_mask, mask_exists
+from lib.utilities_clean import clean_tiled, get_mask_provider, clean_sampled, get_tiled_memory
+from lib.utilities_geometry import clean_aligned
+from lib.utilities_alignment import create_warp_transforms, parse_elastix
+from lib.utilities_stats import get_section_stats
 
-def fix_ntb(file_keys):
+# fix_ntb holds the image, the mask, the masked image and the float64 scaled image and its product with the mask
+FIX_NTB_COPIES = 11
+
+def fix_ntb(file_keys, mask=None, step=1):
     """
     This method clean all NTB images in the specified channel. For channel one it also scales
     and does an adaptive histogram equalization.
@@ -29,38 +43,58 @@ def fix_ntb(file_keys):
     file_keys is a tuple of the following:
         :param infile: file path of image to read
         :param outpath: file path of image to write
-        :param mask: binary mask image of the image
+        :param mask: binary mask image of the image, 8 bit or packed
         :param rotation: amount of rotation. 1 = rotate by 90degrees
         :param flip: either flip or flop
         :param max_width: width of image
         :param max_height: height of image
         :param scale: used in scaling. Gotten from the histogram
+        :param channel: channel {1,2,3}
+        :param virtual: True when maskfile is a thumbnail mask that gets upsampled to the image size
+    :param mask: the mask already read by clean_channels, read from maskfile when None
+    :param step: 1 for the OpenCV CLAHE, n to build the CLAHE tables from every nth row and column
     :return: nothing. we write the image to disk
     """
-    infile, outpath, maskfile, rotation, flip, max_width, max_height, scale, channel = file_keys
+    infile, outpath, maskfile, rotation, flip, max_width, max_height, scale, channel, virtual = file_keys
     try:
         img = io.imread(infile)
     except:
         print(f'Could not open {infile}')
-        
+
+    shared = mask is not None
     try:
-        mask = cv2.imread(maskfile, cv2.IMREAD_GRAYSCALE)
+        if virtual and not shared:
+            mask = VirtualMask(maskfile, img.shape[1], img.shape[0])
+        elif not shared:
+            mask = load_mask(maskfile)
     except:
         print(f'Mask {maskfile} does not exist')
         sys.exit()
 
     try:
-        fixed = cv2.bitwise_and(img, img, mask=mask)
+        if virtual:
+            fixed = apply_mask(img, mask)
+            if channel == 1:
+                mask = mask.full()
+        else:
+            fixed = cv2.bitwise_and(img, img, mask=mask)
     except:
         print(f'Error in masking {infile} with mask shape {mask.shape} img shape {img.shape}')
         print('Are the shapes exactly the same?')
         print("Unexpected error:", sys.exc_info()[0])
         raise
         sys.exit()
-        
+
+    # the statistics are made from the image and mask already in memory when they are not cached
+    stats = None
+    if channel == 1 and not virtual and step == 1:
+        stats = get_section_stats(infile, maskfile, img=img, mask=mask)
     del img
-    if channel == 1:
-        fixed = scaled(fixed, mask, scale, epsilon=0.01)
+    if channel == 1 and step > 1:
+        # the lookup tables of clean_tiled from every step-th row and column, the masked values are the same
+        fixed = clean_sampled(fixed, mask, scale, step)
+    elif channel == 1:
+        fixed = scaled(fixed, mask, scale, epsilon=0.01, stats=stats)
         fixed = equalized(fixed)
     del mask
     if rotation > 0:
@@ -76,24 +110,56 @@ def fix_ntb(file_keys):
     del fixed
     return
 
-def masker(animal, channel, downsample, scale, debug,workers):
+def clean_channels(file_key):
+    """
+    Cleans all the channels of one section with one read of the mask. The channels
+    are done in threads that share the mask, which they only read.
+    file_key is a tuple of the following:
+        :param worker: partial of fix_ntb, clean_tiled or clean_aligned
+        :param channel_keys: list of the file_keys of the worker, one per channel
+    :return: nothing. we write the images to disk
+    """
+    worker, channel_keys = file_key
+    infile, _, maskfile = channel_keys[0][:3]
+    virtual = channel_keys[0][9]
+    whole = worker.func is fix_ntb
+    if whole and not virtual:
+        mask = load_mask(maskfile)
+    else:
+        header = read_image_header(infile)
+        if whole:
+            mask = VirtualMask(maskfile, header['width'], header['height'])
+        else:
+            mask = get_mask_provider(maskfile, header['width'], header['height'], virtual)
+    with ThreadPoolExecutor(max_workers=len(channel_keys)) as executor:
+        futures = [executor.submit(worker, channel_key, mask) for channel_key in channel_keys]
+        for future in futures:
+            future.result()
+
+
+def masker(animal, channel, downsample, scale, debug, workers, tiled=False, align=False, step=1):
     """
     Main method that starts the cleaning/rotating process.
     :param animal:  prep_id of the animal we are working on.
-    :param channel:  channel {1,2,3}
+    :param channel:  channel {1,2,3} or all to clean every channel of a section in one task
     :param flip:  flip or flop or nothing
     :param rotation: usually 1 for rotating 90 degrees
     :param full:  resolution, either full or thumbnail
+    :param tiled: for full resolution, use clean_tiled which works a block at a time
+        and writes tiled tifs instead of loading whole sections in fix_ntb
+    :param align: for full resolution, clean and align in one pass with clean_aligned
+        and write to full_aligned without making full_cleaned
+    :param workers: most processes to run, fewer run at once when the sections do not fit in memory
+    :param step: for full resolution, build the CLAHE tables of channel 1 from every
+        step-th row and column instead of every pixel
     :return: nothing, writes to disk the cleaned image
+    For full resolution, when a mask is not in masks/full_masked the thumbnail
+    mask is upsampled in memory instead, see create_masks.py --virtual
     """
     sqlController = SqlController(animal)
     fileLocationManager = FileLocationManager(animal)
-    channel_dir = 'CH{}'.format(channel)
-    CLEANED = os.path.join(fileLocationManager.prep, channel_dir, 'thumbnail_cleaned')
-    INPUT = os.path.join(fileLocationManager.prep, channel_dir, 'thumbnail')
-
     MASKS = os.path.join(fileLocationManager.prep, 'masks', 'thumbnail_masked')
-    os.makedirs(CLEANED, exist_ok=True)
+    THUMBNAIL_MASKS = MASKS
     width = sqlController.scan_run.width
     height = sqlController.scan_run.height
     rotation = sqlController.scan_run.rotation
@@ -101,72 +167,123 @@ def masker(animal, channel, downsample, scale, debug,workers):
     max_width = int(width * SCALING_FACTOR)
     max_height = int(height * SCALING_FACTOR)
     stain = sqlController.histology.counterstain
-    if channel == 1:
-        sqlController.set_task(animal, CLEAN_CHANNEL_1_THUMBNAIL_WITH_MASK)
-
+    resolution = 'thumbnail'
     if not downsample:
-        CLEANED = os.path.join(fileLocationManager.prep, channel_dir, 'full_cleaned')
-        os.makedirs(CLEANED, exist_ok=True)
-        INPUT = os.path.join(fileLocationManager.prep, channel_dir, 'full')
         MASKS = os.path.join(fileLocationManager.prep, 'masks', 'full_masked')
         max_width = width
         max_height = height
+        resolution = 'full'
+        if align:
+            transforms = create_warp_transforms(animal, parse_elastix(animal), downsample)
 
+    if str(channel).lower() == 'all':
+        channels = [c for c in [1, 2, 3]
+                    if os.path.exists(os.path.join(fileLocationManager.prep, f'CH{c}', resolution))]
+    else:
+        channels = [int(channel)]
 
-    error = test_dir(animal, INPUT, downsample, same_size=False)
-    if len(error) > 0:
-        print(error)
-        sys.exit()
-    files = sorted(os.listdir(INPUT))
-    progress_id = sqlController.get_progress_id(downsample, channel, 'CLEAN')
-    sqlController.set_task(animal, progress_id)
-
-    file_keys = []
-    for file in files:
-        infile = os.path.join(INPUT, file)
-        outpath = os.path.join(CLEANED, file)
-        if os.path.exists(outpath):
-            continue
-        maskfile = os.path.join(MASKS, file)
-
-        if 'thion' in stain.lower():
-            print('Not implemented.')
-            #fixed = fix_thion(infile, mask, maskfile, logger, rotation, flip, max_width, max_height)
-        else:
-            file_keys.append([infile, outpath, maskfile, rotation, flip, max_width, max_height, scale, channel])
+    section_keys = {}
+    section_memory = {}
+    n_files = 0
+    for channel in channels:
+        channel_dir = 'CH{}'.format(channel)
+        INPUT = os.path.join(fileLocationManager.prep, channel_dir, resolution)
+        CLEANED = os.path.join(fileLocationManager.prep, channel_dir, f'{resolution}_cleaned')
+        if not downsample and align:
+            CLEANED = os.path.join(fileLocationManager.prep, channel_dir, 'full_aligned')
+        os.makedirs(CLEANED, exist_ok=True)
+        if channel == 1:
+            sqlController.set_task(animal, CLEAN_CHANNEL_1_THUMBNAIL_WITH_MASK)
+
+        error = test_dir(animal, INPUT, downsample, same_size=False)
+        if len(error) > 0:
+            print(error)
+            sys.exit()
+        files = sorted(os.listdir(INPUT))
+        n_files += len(files)
+        manifest = load_manifest(INPUT)
+        progress_id = sqlController.get_progress_id(downsample, channel, 'CLEAN')
+        sqlController.set_task(animal, progress_id)
+
+        for file in files:
+            infile = os.path.join(INPUT, file)
+            outpath = os.path.join(CLEANED, file)
+            if os.path.exists(outpath):
+                continue
+            maskfile = os.path.join(MASKS, file)
+            virtual = not downsample and not mask_exists(maskfile)
+            if virtual:
+                maskfile = os.path.join(THUMBNAIL_MASKS, file)
 
+            if 'thion' in stain.lower():
+                print('Not implemented.')
+                #fixed = fix_thion(infile, mask, maskfile, logger, rotation, flip, max_width, max_height)
+            else:
+                file_key = [infile, outpath, maskfile, rotation, flip, max_width, max_height, scale, channel, virtual]
+                if not downsample and align:
+                    if file not in transforms:
+                        print(f'No alignment for {file}')
+                        continue
+                    file_key.append(transforms[file])
+                section_keys.setdefault(file, []).append(file_key)
+                section = manifest.get(file, {})
+                section_width = section.get('width') or max_width
+                section_height = section.get('height') or max_height
+                if not downsample and (tiled or align):
+                    memory = TASK_OVERHEAD + get_tiled_memory(section_width, section_height)
+                else:
+                    memory = get_task_memory(section_width, section_height, section.get('dtype') or np.uint16, copies=FIX_NTB_COPIES)
+                # the channels of a section run at the same time in clean_channels
+                section_memory[file] = section_memory.get(file, 0) + memory
+
+    worker = fix_ntb
+    if not downsample and tiled:
+        worker = clean_tiled
+    if not downsample and align:
+        worker = clean_aligned
+    worker = partial(worker, step=1 if downsample else step)
+    if len(channels) == 1:
+        file_keys = [channel_keys[0] for channel_keys in section_keys.values()]
+    else:
+        file_keys = [(worker, channel_keys) for channel_keys in section_keys.values()]
+        worker = clean_channels
+    memory = list(section_memory.values())
     start = timer()
-    # workers = 20 # this is the upper limit. More than this and it crashes.
+    # workers = 20 # this is the upper limit with fix_ntb. More than this and it crashes.
     if debug:
         print(f'debugging with single core')
         for file_key in tqdm(file_keys):
-            fix_ntb(file_key)
+            worker(file_key)
     else:
-        print(f'Working on {len(file_keys)} files with {workers} cpus')
-        with ProcessPoolExecutor(max_workers=workers) as executor:
-            #executor.map(fix_ntb, sorted(file_keys),np.ones(len(file_keys))*channel)
-            executor.map(fix_ntb, sorted(file_keys))
+        print(f'Working on {len(file_keys)} sections of channels {channels} with up to {workers} cpus')
+        run_memory_bounded(worker, file_keys, memory, workers)
 
     end = timer()
     print(f'Create cleaned files took {end - start} seconds total', end="\t")
-    print(f' { (end - start)/len(files)} per file')
+    print(f' { (end - start)/max(n_files, 1)} per file')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal', required=True)
-    parser.add_argument('--channel', help='Enter channel', required=True)
+    parser.add_argument('--channel', help='Enter channel or all to clean every channel with one read of the mask', required=True)
     parser.add_argument('--downsample', help='Enter true or false', required=False, default='true')
     parser.add_argument('--scale', help='Enter scaling', required=False, default=45000)
     parser.add_argument('--debug', help='Enter true or false', required=False, default='false')
-    parser.add_argument('--njobs', help='number of core to use for parallel processing muralus can handle 20-25 ratto can handle 4', required=False, default=4)
+    parser.add_argument('--tiled', help='Enter true to clean full resolution a block at a time into tiled, deflate compressed tifs', required=False, default='false')
+    parser.add_argument('--align', help='Enter true to clean and align full resolution in one pass', required=False, default='false')
+    parser.add_argument('--step', help='Enter n > 1 to build the full resolution CLAHE from every nth row and column', required=False, default=1)
+    parser.add_argument('--njobs', help='most cores to use, fewer are used when the sections do not fit in memory', required=False, default=4)
 
 
     args = parser.parse_args()
     animal = args.animal
-    channel = int(args.channel)
+    channel = args.channel
     scale = int(args.scale)
     downsample = bool({'true': True, 'false': False}[str(args.downsample).lower()])
     debug = bool({'true': True, 'false': False}[str(args.debug).lower()])
     workers = int(args.njobs)
-    masker(animal, channel, downsample, scale, debug,workers)
+    tiled = bool({'true': True, 'false': False}[str(args.tiled).lower()])
+    align = bool({'true': True, 'false': False}[str(args.align).lower()])
+    step = int(args.step)
+    masker(animal, channel, downsample, scale, debug, workers, tiled, align, step)
 
@@ -8,15 +8,19 @@ This file does the following operations:
 """
 import os, sys
 import argparse
-import subprocess
+import shutil
 from multiprocessing.pool import Pool
 from lib.file_location import FileLocationManager
 from lib.utilities_process import workernoshell, test_dir
+from lib.utilities_transform_cache import get_file_hash, get_parameter_hash, get_pair_key, \
+    read_pair_key, write_pair_key
 ELASTIX_BIN = '/usr/bin/elastix'
 def run_elastix(animal, njobs):
     """
     Sets up the arguments for running elastix in a sequence. Each file pair
     creates a sub directory with the results. Uses a pool to spawn multiple processes
+    A pair is only run again when its images or the parameter file changed, the
+    results of pairs seen before are copied from elastix/.cache
     Args:
         animal: the animal
         limit:  how many jobs you want to run.
@@ -39,7 +43,14 @@ def run_elastix(animal, njobs):
         print(f'Could not find {param_file}')
         sys.exit()
 
+    CACHE = os.path.join(elastix_output_dir, '.cache')
+    os.makedirs(CACHE, exist_ok=True)
+    with open(param_file, 'rb') as fh:
+        parameter_hash = get_parameter_hash(fh.read())
+    hashes = [get_file_hash(os.path.join(INPUT, file)) for file in files]
+
     commands = []
+    pending = []
     # previous file is the fixed image
     # current file is the moving image
     for i in range(1, len(files)):
@@ -51,17 +62,33 @@ def run_elastix(animal, njobs):
         new_dir = '{}_to_{}'.format(curr_img_name, prev_img_name)
         output_subdir = os.path.join(elastix_output_dir, new_dir)
 
-        if os.path.exists(output_subdir) and 'TransformParameters.0.txt' in os.listdir(output_subdir):
+        key = get_pair_key(hashes[i - 1], hashes[i], parameter_hash)
+        result = os.path.join(output_subdir, 'TransformParameters.0.txt')
+        if os.path.exists(result) and read_pair_key(output_subdir) == key:
             continue
-        command = ['rm', '-rf', output_subdir]
-        subprocess.run(command)
+        shutil.rmtree(output_subdir, ignore_errors=True)
         os.makedirs(output_subdir, exist_ok=True)
+        cached = os.path.join(CACHE, f'{key}.txt')
+        if os.path.exists(cached):
+            shutil.copyfile(cached, result)
+            write_pair_key(output_subdir, key)
+            continue
         cmd = [ELASTIX_BIN, '-f', prev_fp, '-m', curr_fp, '-p', param_file, '-out', output_subdir]
         commands.append(cmd)
+        pending.append((output_subdir, key))
 
+    print(f'Running elastix on {len(commands)} of {len(files) - 1} pairs')
     with Pool(njobs) as p:
         p.map(workernoshell, commands)
 
+    for output_subdir, key in pending:
+        result = os.path.join(output_subdir, 'TransformParameters.0.txt')
+        if not os.path.exists(result):
+            print(f'elastix did not finish {output_subdir}')
+            continue
+        shutil.copyfile(result, os.path.join(CACHE, f'{key}.txt'))
+        write_pair_key(output_subdir, key)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal', required=True)
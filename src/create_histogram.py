@@ -1,19 +1,19 @@
 """
 This program creates histograms for each tif file or creates a combined histogram of all files.
+The histograms come from the cached statistics of each section, see lib/utilities_stats.py,
+so the images are only read again when they or their masks change.
 """
 import argparse
 import os, sys
-from collections import Counter
 from matplotlib import pyplot as plt
-from skimage import io
 from tqdm import tqdm
 import numpy as np
-import cv2
 
 from lib.file_location import FileLocationManager
 from lib.logger import get_logger
 from lib.sqlcontroller import SqlController
 from lib.utilities_process import test_dir
+from lib.utilities_stats import get_section_stats, get_masked_image_histogram
 
 COLORS = {1: 'b', 2: 'r', 3: 'g'}
 
@@ -58,35 +58,16 @@ def make_histogram(animal, channel):
         if os.path.exists(output_path):
             continue
 
-        try:
-            img = io.imread(input_path)
-        except:
-            logger.warning(f'Could not open {input_path}')
-            continue
-        try:
-            mask = io.imread(mask_path)
-        except:
-            logger.warning(f'Could not open {mask_path}')
-            continue
-
-        img = cv2.bitwise_and(img, img, mask=mask)
-
-
-        if img.shape[0] * img.shape[1] > 1000000000:
-            scale = 1 / float(2)
-            img = img[::int(1. / scale), ::int(1. / scale)]
-
-
-
-        try:
-            flat = img.flatten()
-        except:
-            logger.warning(f'Could not flat {input_path}')
+        stats = get_section_stats(input_path, mask_path)
+        if stats is None:
+            logger.warning(f'Could not open {input_path} or {mask_path}')
             continue
+        hist = get_masked_image_histogram(stats)
+        values = np.flatnonzero(hist)
 
         fig = plt.figure()
         plt.rcParams['figure.figsize'] = [10, 6]
-        plt.hist(flat, flat.max(), [0, 10000], color=COLORS[channel])
+        plt.hist(values, values.max(), [0, 10000], weights=hist[values], color=COLORS[channel])
         plt.style.use('ggplot')
         plt.yscale('log')
         plt.grid(axis='y', alpha=0.75)
@@ -112,59 +93,31 @@ def make_combined(animal, channel):
     os.makedirs(OUTPUT, exist_ok=True)
     tifs = os.listdir(INPUT)
     lfiles = len(tifs)
-    hist_dict = Counter({})
+    total = None
 
     for i, tif in enumerate(tqdm(tifs)):
         filename = str(i).zfill(3) + '.tif'
         input_path = os.path.join(INPUT, filename)
         mask_path = os.path.join(MASK_INPUT, filename)
 
-        try:
-            img = io.imread(input_path)
-        except:
-            logger.error(f'Could not read {input_path}')
+        stats = get_section_stats(input_path, mask_path)
+        if stats is None:
+            logger.error(f'Could not read {input_path} or {mask_path}')
             lfiles -= 1
-            break
-
-        try:
-            mask = io.imread(mask_path)
-        except:
-            logger.warning(f'Could not open {mask_path}')
             continue
+        hist = get_masked_image_histogram(stats)
+        if total is None:
+            total = hist
+        else:
+            total = total + hist
 
-        # mask image
-        img = cv2.bitwise_and(img, img, mask=mask)
-
-        try:
-            flat = img.flatten()
-            #flat = np.random.choice(flat, 1000)
-            del img
-        except:
-            logger.error(f'Could not flatten file {input_path}')
-            lfiles -= 1
-            break
-        try:
-            #hist,bins = np.histogram(flat, bins=nbins)
-            img_counts = np.bincount(flat)
-        except:
-            logger.error(f'Could not create counts {input_path}')
-            lfiles -= 1
-            break
-        try:
-            img_dict = Counter(dict(zip(np.unique(flat), img_counts[img_counts.nonzero()])))
-        except:
-            logger.error(f'Could not create counter {input_path}')
-            lfiles -= 1
-            break
-        try:
-            hist_dict = hist_dict + img_dict
-        except:
-            logger.error(f'Could not add files {input_path}')
-            lfiles -= 1
-            break
+    if total is None:
+        print(f'None of the sections in {INPUT} could be read with their masks, there is no combined histogram')
+        return
 
+    values = np.flatnonzero(total)
+    hist_dict = dict(zip(values, total[values]))
 
-    hist_dict = dict(hist_dict)
     hist_values = [i/lfiles for i in hist_dict.values()]
 
     fig = plt.figure()
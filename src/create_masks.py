@@ -6,21 +6,30 @@ import torch.utils.data
 from PIL import Image
 import cv2
 from tqdm import tqdm
+from multiprocessing import Process
 from multiprocessing.pool import Pool
 import torchvision
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 from abakit.utilities.file_location import FileLocationManager 
-from abakit.utilities.shell_tools import workernoshell, get_image_size
+from abakit.utilities.shell_tools import workernoshell
 from abakit.utilities.masking import combine_dims, merge_mask
 
 from sql_setup import CREATE_FULL_RES_MASKS
 from lib.sqlcontroller import SqlController
-from lib.utilities_process import test_dir
+from lib.utilities_process import test_dir, get_image_size
+from lib.utilities_packed_mask import write_packed_mask, get_packed_path
+from lib.utilities_journal import remove_file
+from lib.utilities_virtual_mask import VirtualMask
 import warnings
 warnings.filterwarnings("ignore")
 
-def create_final(animal):
+def create_final(animal, packed=False):
+    """
+    Takes the red channel of the colored masks as the final thumbnail masks.
+    :param animal: the prep_id of the animal we are working with
+    :param packed: True to write bit packed masks (.pmask) instead of 8 bit tifs
+    """
     fileLocationManager = FileLocationManager(animal)
     COLORED = os.path.join(fileLocationManager.prep, 'masks', 'thumbnail_colored')
     MASKS = os.path.join(fileLocationManager.prep, 'masks', 'thumbnail_masked')
@@ -35,6 +44,8 @@ def create_final(animal):
     for file in tqdm(files):
         filepath = os.path.join(COLORED, file)
         maskpath = os.path.join(MASKS, file)
+        if packed:
+            maskpath = get_packed_path(maskpath)
 
         if os.path.exists(maskpath):
             continue
@@ -42,7 +53,10 @@ def create_final(animal):
         mask = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
         mask = mask[:,:,2]
         mask[mask>0] = 255
-        cv2.imwrite(maskpath, mask.astype(np.uint8))
+        if packed:
+            write_packed_mask(maskpath, mask)
+        else:
+            cv2.imwrite(maskpath, mask.astype(np.uint8))
 
 
 def get_model_instance_segmentation(num_classes):
@@ -59,15 +73,115 @@ def get_model_instance_segmentation(num_classes):
     model.roi_heads.mask_predictor = MaskRCNNPredictor(in_features_mask, hidden_layer, num_classes)
     return model
 
-def create_mask(animal, downsample, njobs):
+MODELPATH = '/net/birdstore/Active_Atlas_Data/data_root/brains_info/masks/mask.model.pth'
 
-    fileLocationManager = FileLocationManager(animal)
-    modelpath = os.path.join('/net/birdstore/Active_Atlas_Data/data_root/brains_info/masks/mask.model.pth')
+
+class ThumbnailDataset(torch.utils.data.Dataset):
+    """
+    Decodes the normalized thumbnails in the DataLoader workers so the
+    next batch is ready while the model works on the current one.
+    """
+
+    def __init__(self, files, INPUT):
+        self.files = files
+        self.INPUT = INPUT
+        self.transform = torchvision.transforms.ToTensor()
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        img = Image.open(os.path.join(self.INPUT, self.files[i]))
+        return self.files[i], self.transform(img), np.array(img)
+
+
+def collate_thumbnails(batch):
+    # the thumbnails are not all the same size, the model takes a list
+    return tuple(zip(*batch))
+
+
+def load_mask_model(modelpath, script=False):
+    """
+    Loads the trained Mask R-CNN, puts it in eval mode once and optionally
+    compiles it with TorchScript.
+    :param modelpath: path of the state dict
+    :param script: True to use torch.jit.script
+    :return: the model ready for inference
+    """
     loaded_model = get_model_instance_segmentation(num_classes=2)
     if os.path.exists(modelpath):
         loaded_model.load_state_dict(torch.load(modelpath,map_location=torch.device('cpu')))
     else:
         print('no model to load')
+    loaded_model.eval()
+    if script:
+        loaded_model = torch.jit.script(loaded_model)
+    return loaded_model
+
+
+def write_colored_mask(pred, raw_img, maskpath):
+    masks = [(pred['masks']>0.5).squeeze().detach().cpu().numpy()]
+    mask = masks[0]
+    dims = mask.ndim
+    if dims > 2:
+        mask = combine_dims(mask)
+
+    mask = mask.astype(np.uint8)
+    mask[mask>0] = 255
+
+    merged_img = merge_mask(raw_img, mask)
+    del mask
+    cv2.imwrite(maskpath, merged_img)
+
+
+def predict_masks(file_key):
+    """
+    Runs one model replica over a list of thumbnails.
+    file_key is a tuple of the following:
+        :param files: file names to do
+        :param INPUT: directory of the normalized thumbnails
+        :param COLORED: directory to write the colored masks to
+        :param batch_size: number of thumbnails per forward pass
+        :param threads: number of torch intra-op threads of this replica
+        :param prefetch: number of DataLoader processes decoding thumbnails
+        :param script: True to use the TorchScript model
+    """
+    files, INPUT, COLORED, batch_size, threads, prefetch, script = file_key
+    torch.set_num_threads(threads)
+    loaded_model = load_mask_model(MODELPATH, script)
+    loader = torch.utils.data.DataLoader(ThumbnailDataset(files, INPUT), batch_size=batch_size,
+                                         num_workers=prefetch, collate_fn=collate_thumbnails)
+    with torch.no_grad():
+        for names, inputs, raw_imgs in tqdm(loader, disable=len(files) == 0):
+            pred = loaded_model(list(inputs))
+            if isinstance(pred, tuple):
+                pred = pred[1] # the scripted model returns (losses, detections)
+            for file, prediction, raw_img in zip(names, pred, raw_imgs):
+                write_colored_mask(prediction, raw_img, os.path.join(COLORED, file))
+
+
+def create_mask(animal, downsample, njobs, batch_size=4, threads=None, replicas=1, prefetch=2, script=False,
+                virtual=False, refresh=False):
+    """
+    Args:
+        animal: the prep id of the animal
+        downsample: True to run the model on the thumbnails, False to resize the thumbnail masks
+            to full resolution
+        njobs: number of processes for the full resolution masks
+        batch_size: number of thumbnails per forward pass of the model
+        threads: torch intra-op threads per replica, the default splits the cpus between replicas
+        replicas: number of model copies running in their own process
+        prefetch: number of processes decoding the thumbnails for each replica
+        script: True to run the TorchScript compiled model
+        virtual: True to skip writing the full resolution masks, create_clean.py
+            then upsamples the thumbnail masks as it needs them
+        refresh: True to make the colored masks older than their normalized thumbnail again,
+            with their final masks. This overwrites the colored masks edited by hand
+    Returns:
+        nothing
+    """
+
+    fileLocationManager = FileLocationManager(animal)
 
     ##### Create directories
 
@@ -75,6 +189,9 @@ def create_mask(animal, downsample, njobs):
     if not downsample:
         sqlController = SqlController(animal)
         sqlController.set_task(animal, CREATE_FULL_RES_MASKS)
+        if virtual:
+            print('Not writing full resolution masks, create_clean.py will use the thumbnail masks')
+            return
         INPUT = os.path.join(fileLocationManager.prep, 'CH1', 'full')
         ##### Check if files in dir are valid
         error = test_dir(animal, INPUT, downsample, same_size=False)
@@ -94,12 +211,16 @@ def create_mask(animal, downsample, njobs):
             thumbfile = os.path.join(THUMBNAIL, file)
 
             outpath = os.path.join(MASKED, file)
-            if os.path.exists(outpath):
+            if os.path.exists(outpath) or os.path.exists(get_packed_path(outpath)):
                 continue
             try:
                 width, height = get_image_size(infile)
             except:
                 print(f'Could not open {infile}')
+            if not os.path.exists(thumbfile) and os.path.exists(get_packed_path(thumbfile)):
+                # packed thumbnail masks give packed full resolution masks
+                write_packed_mask(get_packed_path(outpath), VirtualMask(thumbfile, width, height).full())
+                continue
             size = f'{width}x{height}!'
             cmd = ['convert', thumbfile, '-resize', size, '-depth', '8', outpath]
             commands.append(cmd)
@@ -108,7 +229,6 @@ def create_mask(animal, downsample, njobs):
             p.map(workernoshell, commands)
     else:
 
-        transform = torchvision.transforms.ToTensor()
         INPUT = os.path.join(fileLocationManager.prep, 'CH1/normalized')
         COLORED = os.path.join(fileLocationManager.prep, 'masks', 'thumbnail_colored')
         error = test_dir(animal, INPUT, downsample, same_size=False)
@@ -119,36 +239,36 @@ def create_mask(animal, downsample, njobs):
         os.makedirs(COLORED, exist_ok=True)
 
         files = sorted(os.listdir(INPUT))
-        debug = False
-        for file in tqdm(files):
-            filepath = os.path.join(INPUT, file)
-            maskpath = os.path.join(COLORED, file)
-
-            if os.path.exists(maskpath):
-                continue
-
-            img = Image.open(filepath)
-            input = transform(img)
-            input = input.unsqueeze(0)
-            loaded_model.eval()
-            with torch.no_grad():
-                pred = loaded_model(input)
-            pred_score = list(pred[0]['scores'].detach().numpy())
-            if debug:
-                print(file, pred_score[0])
-            masks = [(pred[0]['masks']>0.5).squeeze().detach().cpu().numpy()]
-            mask = masks[0]
-            dims = mask.ndim
-            if dims > 2:
-                mask = combine_dims(mask)
-
-            raw_img = np.array(img)
-            mask = mask.astype(np.uint8)
-            mask[mask>0] = 255
-
-            merged_img = merge_mask(raw_img, mask)
-            del mask
-            cv2.imwrite(maskpath, merged_img)
+        stale = []
+        if refresh:
+            # the sections normalized again after QC edits are newer than their masks
+            stale = [file for file in files if os.path.exists(os.path.join(COLORED, file))
+                     and os.path.getmtime(os.path.join(COLORED, file)) < os.path.getmtime(os.path.join(INPUT, file))]
+            # create_final skips the final masks that exist, the ones of the stale sections are made again
+            MASKS = os.path.join(fileLocationManager.prep, 'masks', 'thumbnail_masked')
+            for file in stale:
+                remove_file(os.path.join(MASKS, file))
+                remove_file(get_packed_path(os.path.join(MASKS, file)))
+            print(f'Making the colored and final masks of {len(stale)} sections again')
+        files = [file for file in files if not os.path.exists(os.path.join(COLORED, file)) or file in stale]
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // replicas)
+        # every replica gets a contiguous part of the files
+        size = -(-len(files) // replicas)
+        chunks = [files[i:i + size] for i in range(0, len(files), size)] if len(files) > 0 else [[]]
+        file_keys = [(chunk, INPUT, COLORED, batch_size, threads, prefetch, script) for chunk in chunks]
+        if len(file_keys) == 1:
+            predict_masks(file_keys[0])
+            return
+        processes = [Process(target=predict_masks, args=(file_key,)) for file_key in file_keys]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [process.exitcode for process in processes if process.exitcode != 0]
+        if len(failed) > 0:
+            print(f'{len(failed)} of {len(processes)} replicas failed, run again to finish the missing masks')
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -157,17 +277,33 @@ if __name__ == '__main__':
     parser.add_argument('--downsample', help='Enter true or false', required=False, default='true')
     parser.add_argument('--njobs', help='How many processes to spawn', default=4, required=False)
     parser.add_argument('--final', help='Enter true or false', required=False, default='false')
+    parser.add_argument('--batch', help='Thumbnails per forward pass of the model', default=4, required=False)
+    parser.add_argument('--threads', help='Torch threads per replica, default splits the cpus', default=None, required=False)
+    parser.add_argument('--replicas', help='Number of model copies running in parallel', default=1, required=False)
+    parser.add_argument('--prefetch', help='Processes decoding thumbnails for each replica', default=2, required=False)
+    parser.add_argument('--script', help='Enter true to use the TorchScript model', required=False, default='false')
+    parser.add_argument('--packed', help='Enter true to write bit packed final masks', required=False, default='false')
+    parser.add_argument('--virtual', help='Enter true to not write the full resolution masks', required=False, default='false')
+    parser.add_argument('--refresh', help='Enter true to redo the masks older than their normalized thumbnail, edited masks are lost', required=False, default='false')
 
     args = parser.parse_args()
     animal = args.animal
     downsample = bool({'true': True, 'false': False}[str(args.downsample).lower()])
     final = bool({'true': True, 'false': False}[str(args.final).lower()])
     njobs = int(args.njobs)
+    batch_size = int(args.batch)
+    threads = None if args.threads is None else int(args.threads)
+    replicas = int(args.replicas)
+    prefetch = int(args.prefetch)
+    script = bool({'true': True, 'false': False}[str(args.script).lower()])
+    virtual = bool({'true': True, 'false': False}[str(args.virtual).lower()])
+    packed = bool({'true': True, 'false': False}[str(args.packed).lower()])
+    refresh = bool({'true': True, 'false': False}[str(args.refresh).lower()])
 
     if final:
-         create_final(animal)
+         create_final(animal, packed)
     else:
-         create_mask(animal, downsample, njobs)
+         create_mask(animal, downsample, njobs, batch_size, threads, replicas, prefetch, script, virtual, refresh)
        
 
 
@@ -10,6 +10,7 @@ import os, sys, time
 from datetime import datetime
 from tqdm import tqdm
 import re
+from multiprocessing.pool import Pool
 
 from lib.file_location import FileLocationManager
 from lib.sqlcontroller import SqlController
@@ -19,11 +20,84 @@ from model.slide_czi_to_tif import SlideCziTif
 from sql_setup import session, SLIDES_ARE_SCANNED, CZI_FILES_ARE_PLACED_ON_BIRDSTORE, CZI_FILES_ARE_SCANNED_TO_GET_METADATA
 
 
-def make_meta(animal, remove):
+def scan_czi(czi_file_path):
     """
-    Scans the czi dir to extract the meta information for each tif file
+    Runs showinf on one czi file. This is the worker used by the process pool
+    in make_meta, so it must not touch the database session.
+    Args:
+        czi_file_path: full path of the czi file
+
+    Returns: tuple of (czi_file_path, metadata_dict, list of full resolution series)
+        metadata_dict and series are None if showinf could not read the file
+    """
+    try:
+        metadata_dict = get_czi_metadata(czi_file_path)
+        series = get_fullres_series_indices(metadata_dict)
+    except Exception as e:
+        print(f'Could not get metadata from {czi_file_path} {e}')
+        return czi_file_path, None, None
+    return czi_file_path, metadata_dict, series
+
+
+def create_slide(scan_id, czi_file, czi_file_path, metadata_dict, series):
+    """
+    Builds the slide and its slide_czi_to_tif rows in memory. The tifs are attached
+    through the slide_czi_tifs relationship so the slide_id gets filled in
+    when the whole batch is flushed.
+    Args:
+        scan_id: primary key of the scan run
+        czi_file: file name of the czi file
+        czi_file_path: full path of the czi file
+        metadata_dict: dictionary from get_czi_metadata
+        series: list of full resolution series from get_fullres_series_indices
+
+    Returns: a slide object that has not been added to the session
+    """
+    slide = Slide()
+    slide.scan_run_id = scan_id
+    slide.slide_physical_id = int(re.findall(r'\d+', czi_file)[1])
+    slide.rescan_number = "1"
+    slide.slide_status = 'Good'
+    slide.processed = False
+    slide.file_size = os.path.getsize(czi_file_path)
+    slide.file_name = czi_file
+    slide.created = datetime.fromtimestamp(os.path.getmtime(czi_file_path))
+    slide.scenes = len(series)
+
+    for j, series_index in enumerate(series):
+        scene_number = j + 1
+        channels = range(metadata_dict[series_index]['channels'])
+        channel_counter = 0
+        width = metadata_dict[series_index]['width']
+        height = metadata_dict[series_index]['height']
+        for channel in channels:
+            tif = SlideCziTif()
+            tif.scene_number = scene_number
+            tif.file_size = 0
+            tif.active = 1
+            tif.width = width
+            tif.height = height
+            tif.scene_index = series_index
+            channel_counter += 1
+            newtif = '{}_S{}_C{}.tif'.format(czi_file, scene_number, channel_counter)
+            newtif = newtif.replace('.czi', '').replace('__','_')
+            tif.file_name = newtif
+            tif.channel = channel_counter
+            tif.processing_duration = 0
+            tif.created = time.strftime('%Y-%m-%d %H:%M:%S')
+            slide.slide_czi_tifs.append(tif)
+    return slide
+
+
+def make_meta(animal, remove, njobs=4):
+    """
+    Scans the czi dir to extract the meta information for each tif file.
+    The showinf calls run in a pool of njobs processes, and all the slide and
+    slide_czi_to_tif rows get written in one transaction at the end.
     Args:
         animal: the animal as primary key
+        remove: delete the existing slides first
+        njobs: number of showinf processes to run at the same time
 
     Returns: nothing
     """
@@ -37,76 +111,53 @@ def make_meta(animal, remove):
         print('Rerun this script as create_meta.py --animal DKXX --remove true')
         sys.exit()
 
-    session.query(Slide).filter(Slide.scan_run_id == scan_id).delete(synchronize_session=False)
-    session.commit()
-
     try:
         czi_files = sorted(os.listdir(fileLocationManager.czi))
     except OSError as e:
         print(e)
         sys.exit()
 
-    section_number = 1
-    for i, czi_file in enumerate(tqdm(czi_files)):
-        extension = os.path.splitext(czi_file)[1]
-        if extension.endswith('czi'):
-            slide = Slide()
-            slide.scan_run_id = scan_id
-            slide.slide_physical_id = int(re.findall(r'\d+', czi_file)[1])
-            slide.rescan_number = "1"
-            slide.slide_status = 'Good'
-            slide.processed = False
-            slide.file_size = os.path.getsize(os.path.join(fileLocationManager.czi, czi_file))
-            slide.file_name = czi_file
-            slide.created = datetime.fromtimestamp(os.path.getmtime(os.path.join(fileLocationManager.czi, czi_file)))
-
-            # Get metadata from the czi file
-            czi_file_path = os.path.join(fileLocationManager.czi, czi_file)
-            metadata_dict = get_czi_metadata(czi_file_path)
-            #print(metadata_dict)
-            series = get_fullres_series_indices(metadata_dict)
-            #print('series', series)
-            slide.scenes = len(series)
-            session.add(slide)
-            session.flush()
-
-            for j, series_index in enumerate(series):
-                scene_number = j + 1
-                channels = range(metadata_dict[series_index]['channels'])
-                #print('channels range and dict', channels,metadata_dict[series_index]['channels'])
-                channel_counter = 0
-                width = metadata_dict[series_index]['width']
-                height = metadata_dict[series_index]['height']
-                for channel in channels:
-                    tif = SlideCziTif()
-                    tif.slide_id = slide.id
-                    tif.scene_number = scene_number
-                    tif.file_size = 0
-                    tif.active = 1
-                    tif.width = width
-                    tif.height = height
-                    tif.scene_index = series_index
-                    channel_counter += 1
-                    newtif = '{}_S{}_C{}.tif'.format(czi_file, scene_number, channel_counter)
-                    newtif = newtif.replace('.czi', '').replace('__','_')
-                    tif.file_name = newtif
-                    tif.channel = channel_counter
-                    tif.processing_duration = 0
-                    tif.created = time.strftime('%Y-%m-%d %H:%M:%S')
-                    session.add(tif)
-                section_number += 1
+    czi_files = [czi_file for czi_file in czi_files if os.path.splitext(czi_file)[1].endswith('czi')]
+    czi_file_paths = [os.path.join(fileLocationManager.czi, czi_file) for czi_file in czi_files]
+
+    results = {}
+    with Pool(njobs) as p:
+        for czi_file_path, metadata_dict, series in tqdm(p.imap_unordered(scan_czi, czi_file_paths),
+                                                         total=len(czi_file_paths)):
+            results[czi_file_path] = (metadata_dict, series)
+
+    new_slides = []
+    for czi_file, czi_file_path in zip(czi_files, czi_file_paths):
+        metadata_dict, series = results[czi_file_path]
+        if metadata_dict is None:
+            continue
+        new_slides.append(create_slide(scan_id, czi_file, czi_file_path, metadata_dict, series))
+
+    try:
+        session.query(Slide).filter(Slide.scan_run_id == scan_id).delete(synchronize_session=False)
+        session.add_all(new_slides)
         session.commit()
+    except Exception as e:
+        print(f'No insert for {animal} {e}')
+        session.rollback()
+        sys.exit()
+
+    tifs = sum(len(slide.slide_czi_tifs) for slide in new_slides)
+    print(f'Inserted {len(new_slides)} slides and {tifs} tifs for {len(czi_files)} czi files')
+
 
 if __name__ == '__main__':
     # Parsing argument
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal', required=True)
     parser.add_argument('--remove', help='Enter true or false', required=False, default='false')
+    parser.add_argument('--njobs', help='How many showinf processes to spawn', default=4, required=False)
     args = parser.parse_args()
     animal = args.animal
     remove = bool({'true': True, 'false': False}
                       [str(args.remove).lower()])
-    make_meta(animal, remove)
+    njobs = int(args.njobs)
+    make_meta(animal, remove, njobs)
     sqlController = SqlController(animal)
     sqlController.set_task(animal, SLIDES_ARE_SCANNED)
     sqlController.set_task(animal, CZI_FILES_ARE_PLACED_ON_BIRDSTORE)
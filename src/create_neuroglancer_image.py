@@ -4,7 +4,6 @@ Creates a shell from  aligned thumbnails
 import argparse
 import os
 import sys
-from concurrent.futures.process import ProcessPoolExecutor
 
 from skimage import io
 from timeit import default_timer as timer
@@ -17,7 +16,7 @@ from lib.file_location import FileLocationManager
 from lib.utilities_cvat_neuroglancer import NumpyToNeuroglancer, calculate_chunks
 from lib.sqlcontroller import SqlController
 from sql_setup import RUN_PRECOMPUTE_NEUROGLANCER_CHANNEL_2_FULL_RES, RUN_PRECOMPUTE_NEUROGLANCER_CHANNEL_3_FULL_RES
-from lib.utilities_process import get_cpus, SCALING_FACTOR, test_dir
+from lib.utilities_process import get_cpus, SCALING_FACTOR, test_dir, get_task_memory, run_memory_bounded
 
 def create_neuroglancer(animal, channel, downsample, workers,debug=False):
     fileLocationManager = FileLocationManager(animal)
@@ -72,12 +71,13 @@ def create_neuroglancer(animal, channel, downsample, workers,debug=False):
     #sys.exit()
 
     start = timer()
-    print(f'Working on {len(file_keys)} files with {workers} cpus')
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        if num_channels == 1:
-            executor.map(ng.process_image, sorted(file_keys))
-        else:
-            executor.map(ng.process_3channel, sorted(file_keys))
+    # the image read, its transposed copy for the volume and the encoded chunks
+    memory = [get_task_memory(width, height, midfile.dtype, copies=3 * num_channels)] * len(file_keys)
+    print(f'Working on {len(file_keys)} files with up to {workers} cpus')
+    if num_channels == 1:
+        run_memory_bounded(ng.process_image, sorted(file_keys), memory, workers)
+    else:
+        run_memory_bounded(ng.process_3channel, sorted(file_keys), memory, workers)
 
 
     end = timer()
@@ -91,7 +91,7 @@ if __name__ == '__main__':
     parser.add_argument('--channel', help='Enter channel', required=True)
     parser.add_argument('--downsample', help='Enter true or false', required=False, default='true')
     parser.add_argument('--debug', help='Enter debug True|False', required=False, default='false')
-    parser.add_argument('--njobs', help='number of core to use for parallel processing muralus can handle 20-25 ratto can handle 4', required=False, default=4)
+    parser.add_argument('--njobs', help='most cores to use, fewer are used when the sections do not fit in memory', required=False, default=4)
 
     args = parser.parse_args()
     animal = args.animal
@@ -1,10 +1,15 @@
 """
 This script will do a histogram equalization and rotation.
 No masking or cleaning. This is to view the images as they are
-for comparison purposes.
+for comparison purposes. The normalized thumbnails are also the input of create_masks.py.
+The checksum of every thumbnail that was normalized is kept next to the output
+directory, e.g., CH1/.normalized.cache.json, and only the thumbnails that changed
+since, e.g., after QC edits, are normalized again.
 """
 import argparse
 import os
+import json
+from multiprocessing.pool import Pool
 
 import cv2
 import numpy as np
@@ -13,30 +18,85 @@ from tqdm import tqdm
 from lib.file_location import FileLocationManager
 from lib.sqlcontroller import SqlController
 from lib.utilities_mask import equalized
+from lib.utilities_journal import get_checksum, get_temp_path
 
 
-def create_normalization(animal, channel):
+def get_cache_path(dir):
+    dir = os.path.normpath(dir)
+    return os.path.join(os.path.dirname(dir), f'.{os.path.basename(dir)}.cache.json')
+
+
+def load_cache(dir):
+    """
+    :param dir: output directory
+    :return: dictionary of file name: checksum of the input it was made from
+    """
+    try:
+        with open(get_cache_path(dir)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(dir, cache):
+    cache_path = get_cache_path(dir)
+    tmp_path = f'{cache_path}.{os.getpid()}'
+    with open(tmp_path, 'w') as fh:
+        json.dump(cache, fh, indent=1, sort_keys=True)
+    os.replace(tmp_path, cache_path)
+
+
+def normalize_image(file_key):
+    """
+    Equalizes one thumbnail when it changed since it was last normalized.
+    file_key is a tuple of the following:
+        :param infile: file path of the thumbnail
+        :param outpath: file path of the normalized thumbnail
+        :param checksum: checksum of the input the existing output was made from, None if it is not known
+    :return: tuple of file name and checksum of the input, or None if the input cannot be read
+    """
+    infile, outpath, checksum = file_key
+    try:
+        new_checksum = get_checksum(infile)
+    except OSError:
+        print(f'Could not open {infile}')
+        return None
+    if os.path.exists(outpath) and checksum == new_checksum:
+        return os.path.basename(outpath), new_checksum
+
+    img = io.imread(infile)
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8) # same as img / 256 without the floats
+
+    fixed = equalized(img).astype(np.uint8)
+    # an output made before there was a cache is kept, with its mtime, when it is what the input gives
+    if checksum is None and os.path.exists(outpath):
+        existing = cv2.imread(outpath, cv2.IMREAD_UNCHANGED)
+        if existing is not None and np.array_equal(existing, fixed):
+            return os.path.basename(outpath), new_checksum
+    temp_path = get_temp_path(outpath)
+    cv2.imwrite(temp_path, fixed)
+    os.replace(temp_path, outpath)
+    return os.path.basename(outpath), new_checksum
+
+
+def create_normalization(animal, channel, njobs):
     fileLocationManager = FileLocationManager(animal)
-    INPUT = fileLocationManager.thumbnail
+    INPUT = os.path.join(fileLocationManager.prep, f'CH{channel}', 'thumbnail')
     OUTPUT = os.path.join(fileLocationManager.prep, f'CH{channel}', 'normalized')
     os.makedirs(OUTPUT, exist_ok=True)
     sqlController = SqlController(animal)
 
     files = sorted(os.listdir(INPUT))
+    cache = load_cache(OUTPUT)
+    file_keys = [(os.path.join(INPUT, file), os.path.join(OUTPUT, file), cache.get(file)) for file in files]
 
-    for file in tqdm(files):
-        infile = os.path.join(INPUT, file)
-        outpath = os.path.join(OUTPUT, file)
-        if os.path.exists(outpath):
-            continue
-
-        img = io.imread(infile)
-
-        if img.dtype == np.uint16:
-            img = (img/256).astype(np.uint8)
-
-        fixed = equalized(img)
-        cv2.imwrite(outpath, fixed.astype(np.uint8))
+    with Pool(njobs) as p:
+        for result in tqdm(p.imap_unordered(normalize_image, file_keys), total=len(file_keys)):
+            if result is not None:
+                file, checksum = result
+                cache[file] = checksum
+    save_cache(OUTPUT, cache)
 
     # set task as completed
     print('Finished')
@@ -46,10 +106,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal', required=True)
     parser.add_argument('--channel', help='Enter channel', required=False,default=1)
+    parser.add_argument('--njobs', help='How many processes to spawn', default=4, required=False)
 
     args = parser.parse_args()
     animal = args.animal
     channel = int(args.channel)
+    njobs = int(args.njobs)
 
-    create_normalization(animal, channel)
-
+    create_normalization(animal, channel, njobs)
@@ -1,7 +1,14 @@
 """
 This file does the following operations:
     1. Converts regular filename from main tif dir to CHX/full or
-    2. Converts and downsamples CHX/full to CHX/thumbnail
+    2. Converts and downsamples CHX/full to CHX/thumbnail, or links the thumbnails made
+    by create_tifs.py --fused true
+    The full dir is only made with --full true. The tifs are copied by default, --stage
+    hardlink, reflink or symlink avoid storing them twice. With hardlink or symlink the
+    files in CHX/full are the tifs themselves, anything that writes to CHX/full in place
+    changes the tifs and their journal entries too.
+    With --czi true, the thumbnails are made from the pyramid levels in the czi files
+    instead of downsampling CHX/full. That also creates the www/scene pngs for channel 1.
     When creating the full sized images, the LZW compression is used
 """
 import argparse
@@ -9,22 +16,25 @@ import os
 import sys
 from multiprocessing.pool import Pool
 from tqdm import tqdm
-from shutil import copyfile
 from sql_setup import CREATE_CHANNEL_3_FULL_RES, \
     CREATE_CHANNEL_2_FULL_RES, CREATE_CHANNEL_3_THUMBNAILS, CREATE_CHANNEL_2_THUMBNAILS
 from lib.file_location import FileLocationManager
 from lib.sqlcontroller import SqlController
-from lib.utilities_process import workernoshell, test_dir, get_image_size
+from lib.utilities_process import test_dir, get_image_size, make_thumbnails_from_czi, \
+    get_memory_bounded_workers, stage_file, SCALING_FACTOR, STAGE_MODES
+from lib.utilities_thumbnail import downsample_tif, get_downsample_memory
 
 
-def make_full_resolution(animal, channel):
+def make_full_resolution(animal, channel, stage='copy'):
     """
     Args:
         animal: the prep id of the animal
         channel: the channel of the stack to process
-        compress: Use the default LZW compression, otherwise just copy the file with the correct name
+        stage: how the numbered files are made from the tif dir: hardlink, reflink, symlink or copy.
+            hardlink and reflink copy the file when they are not possible, e.g., across filesystems.
+            Replicated sections all point to the same file.
     Returns:
-        list of commands
+        nothing
     """
 
     fileLocationManager = FileLocationManager(animal)
@@ -40,6 +50,8 @@ def make_full_resolution(animal, channel):
     os.makedirs(OUTPUT, exist_ok=True)
 
     sections = sqlController.get_sections(animal, channel)
+    staged = {}
+    sizes = {}
     for section_number, section in enumerate(tqdm(sections)):
         input_path = os.path.join(INPUT, section.file_name)
         output_path = os.path.join(OUTPUT, str(
@@ -52,19 +64,30 @@ def make_full_resolution(animal, channel):
         if os.path.exists(output_path):
             continue
 
-        copyfile(input_path, output_path)
-        width, height = get_image_size(input_path)
-        sqlController.update_tif(section.id, width, height)
+        if input_path in staged:
+            # a replicated section, link to the file already staged so it is not copied again
+            stage_file(staged[input_path], output_path, stage if stage == 'symlink' else 'hardlink')
+        else:
+            stage_file(input_path, output_path, stage)
+            staged[input_path] = output_path if stage != 'symlink' else input_path
+        if section.id not in sizes:
+            sizes[section.id] = get_image_size(input_path)
 
+    sqlController.update_tifs(sizes)
 
-def make_low_resolution(animal, channel):
+
+def make_low_resolution(animal, channel, njobs):
     """
     Args:
         takes the full resolution tifs and downsamples them.
+        The tifs are read in strips and area averaged in process. The number of
+        processes is capped by the memory one file needs.
+        Thumbnails already made by create_tifs.py --fused are linked instead.
         animal: the prep id of the animal
         channel: the channel of the stack to process
+        njobs: most number of processes to use
     Returns:
-        list of commands
+        nothing
     """
     sqlController = SqlController(animal)
 
@@ -72,7 +95,7 @@ def make_low_resolution(animal, channel):
         sqlController.set_task(animal, CREATE_CHANNEL_2_THUMBNAILS)
         sqlController.set_task(animal, CREATE_CHANNEL_3_THUMBNAILS)
     fileLocationManager = FileLocationManager(animal)
-    commands = []
+    file_keys = []
     INPUT = os.path.join(fileLocationManager.prep, f'CH{channel}', 'full')
     ##### Check if files in dir are valid
     error = test_dir(animal, INPUT, downsample=False, same_size=False)
@@ -81,6 +104,10 @@ def make_low_resolution(animal, channel):
         sys.exit()
     OUTPUT = os.path.join(fileLocationManager.prep, f'CH{channel}', 'thumbnail')
     os.makedirs(OUTPUT, exist_ok=True)
+    staged = {}
+    sections = sqlController.get_sections(animal, channel)
+    for section_number, section in enumerate(sections):
+        staged[str(section_number).zfill(3) + '.tif'] = os.path.join(fileLocationManager.tif_thumbnail, section.file_name)
     tifs = sorted(os.listdir(INPUT))
     for tif in tifs:
         input_path = os.path.join(INPUT, tif)
@@ -89,23 +116,45 @@ def make_low_resolution(animal, channel):
         if os.path.exists(output_path):
             continue
 
-        cmd = ['convert', input_path, '-resize', '3.125%', '-compress', 'lzw', output_path]
-        commands.append(cmd)
+        if tif in staged and os.path.exists(staged[tif]):
+            stage_file(staged[tif], output_path)
+            continue
+
+        file_keys.append((input_path, output_path, SCALING_FACTOR))
 
-    with Pool(4) as p:
-        p.map(workernoshell, commands)
+    if len(file_keys) == 0:
+        return
+    task_memory = max(get_downsample_memory(input_path, SCALING_FACTOR) for input_path, _, _ in file_keys)
+    workers = get_memory_bounded_workers(njobs, task_memory)
+    print(f'Working on {len(file_keys)} files with {workers} cpus')
+    with Pool(workers) as p:
+        p.map(downsample_tif, file_keys, chunksize=1)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal animal', required=True)
     parser.add_argument('--channel', help='Enter channel', required=True)
+    parser.add_argument('--czi', help='Enter true to make thumbnails from the czi pyramid', required=False, default='false')
+    parser.add_argument('--njobs', help='How many processes to spawn', default=4, required=False)
+    parser.add_argument('--full', help='Enter true to also make the full dir', required=False, default='false')
+    parser.add_argument('--stage', help='How to make the full dir: copy, reflink, hardlink or symlink, '
+                        'hardlink and symlink share the files with the tif dir',
+                        required=False, default='copy', choices=STAGE_MODES)
 
     args = parser.parse_args()
     animal = args.animal
     channel = int(args.channel)
-    #make_full_resolution(animal, channel)
-    make_low_resolution(animal, channel)
+    czi = bool({'true': True, 'false': False}[str(args.czi).lower()])
+    njobs = int(args.njobs)
+    stage = args.stage
+    full = bool({'true': True, 'false': False}[str(args.full).lower()])
+    if full:
+        make_full_resolution(animal, channel, stage)
+    if czi:
+        make_thumbnails_from_czi(animal, channel, njobs)
+    else:
+        make_low_resolution(animal, channel, njobs)
 
     sqlController = SqlController(animal)
     if channel == 1:
@@ -3,25 +3,41 @@ This file does the following operations:
     1. Queries the sections view to get active tifs to be created.
     2. Runs the bfconvert bioformats command to yank the tif out of the czi and place
     it in the correct directory with the correct name
+    With --native true, the czi files are read in process instead. Every channel of every
+    scene is written in one pass over each czi file, so there is no need to run this per channel.
+    With --fused true as well, the thumbnail (tif_thumbnail dir) and the web png of each
+    scene are made from the scene just written, so create_preps.py does not read the full tifs.
+    The tifs are written to a temporary name and renamed when complete. Finished tifs go in
+    a journal (size and crc32) next to the tif dir, so a rerun only redoes the failed scenes.
     3. If you  want jp2 files, the bioformats tool will die as the memory requirements are too high.
     To create jp2, first create uncompressed tif files and then use Matlab to create the jp2 files.
     The Matlab script is in registration/tif2jp2.sh
 """
 import argparse
 
-from lib.utilities_process import make_tifs, make_scenes
+from lib.utilities_process import make_tifs, make_scenes, extract_tifs
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal', required=True)
     parser.add_argument('--channel', help='Enter channel', required=True)
     parser.add_argument('--njobs', help='How many processes to spawn', default=4, required=False)
+    parser.add_argument('--native', help='Enter true to read all channels in process', required=False, default='false')
+    parser.add_argument('--fused', help='Enter true to also make the thumbnails and scene pngs with --native',
+                        required=False, default='false')
+    parser.add_argument('--verify', help='Enter true to compare the checksums of the finished tifs', required=False, default='false')
 
     args = parser.parse_args()
     animal = args.animal
     njobs = int(args.njobs)
     channel = int(args.channel)
+    native = bool({'true': True, 'false': False}[str(args.native).lower()])
+    verify = bool({'true': True, 'false': False}[str(args.verify).lower()])
+    fused = bool({'true': True, 'false': False}[str(args.fused).lower()])
 
-    make_tifs(animal, channel, njobs)
+    if native:
+        extract_tifs(animal, njobs, verify, fused)
+    else:
+        make_tifs(animal, channel, njobs, verify)
     if channel == 1:
         make_scenes(animal)
@@ -7,10 +7,12 @@ into the database if given a layer name.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pprint import pprint
 import os
 import sys
+import shutil
 from datetime import datetime
 
 HOME = os.path.expanduser("~")
@@ -18,48 +20,79 @@ DIR = os.path.join(HOME, 'programming/pipeline_utility/src')
 sys.path.append(DIR)
 from lib.sqlcontroller import SqlController
 from lib.file_location import FileLocationManager
-from lib.utilities_alignment import parameter_elastix_parameter_file_to_dict
+from lib.utilities_alignment import read_transform_parameters
 
-def slurp(animal):
+
+def harvest_pair(file_key):
+    """
+    :param file_key: tuple of the moving section and the elastix output directory of the pair
+    :return: tuple of the moving section and (rotation, xshift, yshift), None when the pair is not complete
+    """
+    moving_index, output_subdir = file_key
+    return moving_index, read_transform_parameters(os.path.join(output_subdir, 'TransformParameters.0.txt'))
+
+
+def get_stale_dirs(ELASTIX, pair_dirs):
+    """
+    :param ELASTIX: elastix output directory of the animal
+    :param pair_dirs: names of the directories of the current pairs of sections
+    :return: paths of the pair directories left from sections that were renamed or removed
+    """
+    with os.scandir(ELASTIX) as entries:
+        return [entry.path for entry in entries
+                if entry.is_dir() and '_to_' in entry.name and entry.name not in pair_dirs]
+
+
+def slurp(animal, njobs):
+    """
+    Reads the transforms of every pair of sections from the elastix output tree, a few
+    directories at a time, and writes them to the database in one transaction.
+    The directories of pairs that are not in the sections any more are removed.
+    :param animal: prep_id of the animal
+    :param njobs: number of directories read at the same time
+    """
     sqlController = SqlController(animal)
     fileLocationManager = FileLocationManager(animal)
-    sqlController.clear_elastix(animal)
-
 
     INPUT = os.path.join(fileLocationManager.prep, 'CH1', 'thumbnail_cleaned')
     if not os.path.exists(INPUT):
         print(f'{INPUT} does not exist')
         sys.exit()
     ELASTIX = fileLocationManager.elastix_dir
-    files = sorted(os.listdir(INPUT))
-    for i in range(1, len(files)):
-        fixed_index = os.path.splitext(files[i - 1])[0]
-        moving_index = os.path.splitext(files[i])[0]
-
-        new_dir = '{}_to_{}'.format(moving_index, fixed_index)
-        output_subdir = os.path.join(ELASTIX, new_dir)
-        filepath = os.path.join(output_subdir, 'TransformParameters.0.txt')
-
-        if os.path.exists(filepath):
-            d = parameter_elastix_parameter_file_to_dict(filepath)
-            rotation, xshift, yshift = d['TransformParameters']
-            sqlController.add_elastix_row(animal, moving_index, rotation, xshift, yshift)
-        else:
-            print(f'{filepath} does not exist')
-
+    indexes = [os.path.splitext(file)[0] for file in sorted(os.listdir(INPUT))]
+    file_keys = []
+    for i in range(1, len(indexes)):
+        new_dir = '{}_to_{}'.format(indexes[i], indexes[i - 1])
+        file_keys.append((indexes[i], os.path.join(ELASTIX, new_dir)))
 
+    rows = []
+    missing = []
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        for moving_index, transform in tqdm(executor.map(harvest_pair, file_keys), total=len(file_keys)):
+            if transform is None:
+                missing.append(moving_index)
+            else:
+                rows.append((moving_index, *transform))
+    for moving_index in missing:
+        print(f'The elastix output of {moving_index} is missing or incomplete')
 
+    stale = get_stale_dirs(ELASTIX, {os.path.basename(output_subdir) for _, output_subdir in file_keys})
+    sqlController.update_elastix_rows(animal, rows)
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        list(executor.map(lambda path: shutil.rmtree(path, ignore_errors=True), stale))
+    print(f'Removed {len(stale)} stale directories from {ELASTIX}')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter animal', required=True)
     parser.add_argument('--debug', help='Enter true of false', required=False, default='true')
-    
+    parser.add_argument('--njobs', help='How many directories to read at the same time', default=8, required=False)
 
     args = parser.parse_args()
     animal = args.animal
     debug = bool({'true': True, 'false': False}[str(args.debug).lower()])
+    njobs = int(args.njobs)
 
-    slurp(animal)    
+    slurp(animal, njobs)    
 
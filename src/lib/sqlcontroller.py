@@ -23,6 +23,7 @@ from model.animal import Animal
 from model.elastix_transformation import ElastixTransformation
 import sys
 import json
+import numpy as np
 import pandas as pd
 from collections import OrderedDict
 from datetime import datetime
@@ -146,6 +147,14 @@ class SqlController(object):
 
         return sections
 
+    def get_slide_file_sizes(self):
+        """
+        Returns: dictionary of czi file name: size in bytes stored by create_meta.py
+        """
+        slides = self.session.query(Slide.file_name, Slide.file_size)\
+            .filter(Slide.scan_run_id == self.scan_run.id).all()
+        return {file_name: file_size for file_name, file_size in slides}
+
     def get_slide_czi_to_tifs(self, channel):
         slides = self.session.query(Slide).filter(Slide.scan_run_id == self.scan_run.id)\
             .filter(Slide.slide_status == 'Good').all()
@@ -196,6 +205,21 @@ class SqlController(object):
             print(f'No merge for  {e}')
             self.session.rollback()
 
+    def update_tifs(self, sizes):
+        """
+        Updates the width and height of many tifs in one transaction
+        :param sizes: dictionary of slide_czi_to_tif id: (width, height)
+        """
+        if len(sizes) == 0:
+            return
+        try:
+            self.session.bulk_update_mappings(SlideCziTif,
+                [{'id': id, 'width': width, 'height': height} for id, (width, height) in sizes.items()])
+            self.session.commit()
+        except Exception as e:
+            print(f'No merge for  {e}')
+            self.session.rollback()
+
     def get_sections_numbers(self, animal):
         sections = self.session.query(Section).filter(
             Section.prep_id == animal).filter(Section.channel == 1).all()
@@ -479,6 +503,36 @@ class SqlController(object):
         self.session.query(ElastixTransformation).filter(ElastixTransformation.prep_id == animal)\
             .delete()
 
+    def update_elastix_rows(self, animal, rows):
+        """
+        Makes the elastix rows of the animal the same as rows in one transaction. Only the
+        sections that are new or whose values changed are written, the rows of the sections
+        that are not in rows any more are removed.
+        :param animal: prep_id of the animal
+        :param rows: list of (section, rotation, xshift, yshift)
+        """
+        wanted = {section: (rotation, xshift, yshift) for section, rotation, xshift, yshift in rows}
+        existing = {}
+        for row in self.session.query(ElastixTransformation).filter(ElastixTransformation.prep_id == animal).all():
+            existing.setdefault(row.section, []).append((row.rotation, row.xshift, row.yshift))
+        stale = [section for section, values in existing.items() if section not in wanted or len(values) != 1
+                 or not np.allclose(values[0], wanted[section], rtol=1e-5, atol=1e-6)]
+        new = [section for section in wanted if section not in existing or section in stale]
+        created = datetime.utcnow()
+        try:
+            if len(stale) > 0:
+                self.session.query(ElastixTransformation).filter(ElastixTransformation.prep_id == animal)\
+                    .filter(ElastixTransformation.section.in_(stale)).delete(synchronize_session=False)
+            self.session.bulk_insert_mappings(ElastixTransformation,
+                [{'prep_id': animal, 'section': section, 'rotation': wanted[section][0],
+                  'xshift': wanted[section][1], 'yshift': wanted[section][2], 'created': created, 'active': True}
+                 for section in new])
+            self.session.commit()
+            print(f'{len(new)} elastix rows written, {len(set(stale) - set(wanted))} removed')
+        except Exception as e:
+            print(f'No merge {e}')
+            self.session.rollback()
+
 
 
 def file_processed(animal, progress_id, filename):
@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 from skimage import io
 from PIL import Image
+import tifffile
 Image.MAX_IMAGE_PIXELS = None
 import pickle
 import re
@@ -12,9 +13,12 @@ from sqlalchemy.orm.exc import NoResultFound
 
 from lib.sqlcontroller import SqlController
 from lib.file_location import FileLocationManager
+from lib.utilities_transform_stack import load_transform_stack, scale_translations
 from model.elastix_transformation import ElastixTransformation
 from sql_setup import session
 
+TRANSFORM_PARAMETERS = re.compile(r'^\(TransformParameters ([^)]*)\)', re.MULTILINE)
+
 
 def load_transforms(stack, downsample_factor=None, resolution=None, use_inverse=True, anchor_filepath=None):
     """
@@ -193,6 +197,29 @@ def parameter_elastix_parameter_file_to_dict(filename):
         return d
 
 
+def read_transform_parameters(filepath):
+    """
+    Reads the rigid transform of a finished elastix pair with one read of the file
+    :param filepath: path of TransformParameters.0.txt
+    :return: tuple of rotation, xshift, yshift, None if the file is missing or incomplete
+    """
+    try:
+        with open(filepath) as fh:
+            text = fh.read()
+    except OSError:
+        return None
+    match = TRANSFORM_PARAMETERS.search(text)
+    if match is None:
+        return None
+    try:
+        parameters = [float(v) for v in match.group(1).split()]
+    except ValueError:
+        return None
+    if len(parameters) != 3 or not np.all(np.isfinite(parameters)):
+        return None
+    return tuple(parameters)
+
+
 def load_elastix_transformation(animal, moving_index):
     try:
         elastixTransformation = session.query(ElastixTransformation).filter(ElastixTransformation.prep_id == animal)\
@@ -215,48 +242,14 @@ def create_elastix_transformation(rotation, xshift, yshift, center):
 
 def parse_elastix(animal):
     """
-    After the elastix job is done, this goes into each subdirectory and parses the Transformation.0.txt file
+    After the elastix job is done, this reads the transforms of every section from the database
+    and composes them into the transforms to the middle section, see utilities_transform_stack
     Args:
         animal: the animal
     Returns: a dictionary of key=filename, value = coordinates
     """
-    fileLocationManager = FileLocationManager(animal)
-    DIR = fileLocationManager.prep
-    INPUT = os.path.join(DIR, 'CH1', 'thumbnail_cleaned')
-
-    files = sorted(os.listdir(INPUT))
-    midpoint = len(files) // 2
-    transformation_to_previous_sec = {}
-    midfilepath = os.path.join(INPUT, files[midpoint])
-    midfile = io.imread(midfilepath, img_num=0)
-    height = midfile.shape[0]
-    width = midfile.shape[1]
-    center = np.array([width, height]) / 2
-    
-    for i in range(1, len(files)):
-        moving_index = os.path.splitext(files[i])[0]
-        rotation, xshift, yshift = load_elastix_transformation(animal, moving_index)
-        T = create_elastix_transformation(rotation, xshift, yshift, center)
-        transformation_to_previous_sec[i] = T
-    
-    
-    transformation_to_anchor_sec = {}
-    # Converts every transformation
-    for moving_index in range(len(files)):
-        if moving_index == midpoint:
-            transformation_to_anchor_sec[files[moving_index]] = np.eye(3)
-        elif moving_index < midpoint:
-            T_composed = np.eye(3)
-            for i in range(midpoint, moving_index, -1):
-                T_composed = np.dot(np.linalg.inv(transformation_to_previous_sec[i]), T_composed)
-            transformation_to_anchor_sec[files[moving_index]] = T_composed
-        else:
-            T_composed = np.eye(3)
-            for i in range(midpoint + 1, moving_index + 1):
-                T_composed = np.dot(transformation_to_previous_sec[i], T_composed)
-            transformation_to_anchor_sec[files[moving_index]] = T_composed
-
-    return transformation_to_anchor_sec
+    files, transforms = load_transform_stack(animal)
+    return dict(zip(files, transforms))
 
 
 
@@ -272,21 +265,9 @@ def create_warp_transforms(animal, transforms, downsample):
     #transforms_scale_factor = \
     #    convert_resolution_string_to_um(animal, downsample=transforms_resol) / \
     #    convert_resolution_string_to_um(animal, downsample=downsample)
-    if downsample:
-        transforms_scale_factor = 1
-    else:
-        transforms_scale_factor = 32
-
-
-    tf_mat_mult_factor = np.array([[1, 1, transforms_scale_factor], [1, 1, transforms_scale_factor]])
-
-    transforms_to_anchor = {}
-    for img_name, tf in transforms.items():
-        transforms_to_anchor[img_name] = \
-            convert_2d_transform_forms(np.reshape(tf, (3, 3))[:2] * tf_mat_mult_factor) 
-    
-
-    return transforms_to_anchor
+    files = list(transforms.keys())
+    stack = np.array([np.reshape(transforms[file], (3, 3)) for file in files]).reshape(-1, 3, 3)
+    return dict(zip(files, scale_translations(stack, downsample)))
 
 def convert_2d_transform_forms(arr):
     return np.vstack([arr, [0, 0, 1]])
@@ -441,7 +422,13 @@ orientation_argparse_str_to_imagemagick_str =     {'transpose': '-transpose',
 
 def process_image(file_key):
     index, infile, outfile, T = file_key
-    im1 = Image.open(infile)
+    try:
+        # PIL only decodes on load, a tif it opens but cannot decode fails there
+        im1 = Image.open(infile)
+        im1.load()
+    except (OSError, ValueError):
+        # sections over 4 GB are written as BigTIFF by clean_tiled and PIL cannot open those
+        im1 = Image.fromarray(tifffile.imread(infile))
     im2 = im1.transform((im1.size), Image.AFFINE, T.flatten()[:6], resample=Image.NEAREST)
     im2.save(outfile)
 
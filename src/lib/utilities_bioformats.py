@@ -1,35 +1,106 @@
+import os
+import json
 import subprocess
+import xml.etree.ElementTree as ET
 
-import bioformats
+METADATA_VERSION = 1
 
-def get_czi_metadata(infile):
+
+def local_name(tag):
+    """
+    The OME namespace changes with the schema version, so tags are matched without it.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_omexml(xml):
+    """
+    Reads the sizes and channels of every image in an OME-XML document
+    :param xml: the OME-XML as a string
+    :return: dictionary of meta information, see get_czi_metadata
+    """
+    root = ET.fromstring(xml)
+    metadata_dict = {}
+    channel_names = None
+    images = [node for node in root if local_name(node.tag) == 'Image']
+    for i, image in enumerate(images):
+        pixels = next(node for node in image if local_name(node.tag) == 'Pixels')
+        channels = [node for node in pixels if local_name(node.tag) == 'Channel']
+        metadata_dict[i] = {}
+        metadata_dict[i]['width'] = int(pixels.get('SizeX'))
+        metadata_dict[i]['height'] = int(pixels.get('SizeY'))
+        metadata_dict[i]['channels'] = len(channels)
+        if channel_names is None:
+            channel_names = [channel.get('Name') for channel in channels]
+
+    for i, name in enumerate(channel_names or []):
+        metadata_dict[f'channel_{i}_name'] = name
+
+    return metadata_dict
+
+
+def get_metadata_cache_path(infile):
+    return f'{infile}.meta.json'
+
+
+def load_cached_metadata(infile):
+    """
+    :param infile: file location of the CZI file
+    :return: the cached dictionary of meta information or None if the czi
+        changed since it was cached
+    """
+    stat = os.stat(infile)
+    try:
+        with open(get_metadata_cache_path(infile)) as fh:
+            cached = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if cached.get('version') != METADATA_VERSION or cached.get('size') != stat.st_size \
+            or cached.get('mtime') != stat.st_mtime_ns:
+        return None
+    # json keys are strings, the series numbers are ints
+    return {int(k) if k.isdigit() else k: v for k, v in cached['metadata'].items()}
+
+
+def save_cached_metadata(infile, metadata_dict):
+    stat = os.stat(infile)
+    cache_path = get_metadata_cache_path(infile)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as fh:
+            json.dump({'version': METADATA_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                       'metadata': metadata_dict}, fh)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'Could not save {cache_path} {e}')
+
+
+def get_czi_metadata(infile, use_cache=True):
     """
     This parses the CZI file with the bioformats tool: showinf.
+    The result is kept next to the czi in a .meta.json file, which is used
+    as long as the size and mtime of the czi do not change.
     :param infile: file location of the CZI file
+    :param use_cache: False to always run showinf
     :return: dictionary of meta information
     """
+    if use_cache:
+        metadata_dict = load_cached_metadata(infile)
+        if metadata_dict is not None:
+            return metadata_dict
+
     command = ['/usr/local/share/bftools/showinf', '-nopix', '-omexml-only', infile]
     metadata = subprocess.check_output(command).decode('utf-8')
-    metadata = bioformats.OMEXML(metadata)
 
     # Series #0 should be the first tissue sample at full resolution.
     # Series #1 tends to be this same tissue sample at half the resolution.
     # This continues halving resolution 5-6 times in succession. We only
     # want the full resolution tissue series so we ignore those with dimensions
     # that are much smaller than expected. Valid series are checked in get_fullres_series_indices
+    metadata_dict = parse_omexml(metadata[metadata.index('<'):])
 
-    metadata_dict = {}
-    for i in range(metadata.image_count):
-        image = metadata.image(i)
-        metadata_dict[i] = {}
-        metadata_dict[i]['width'] = image.Pixels.SizeX
-        metadata_dict[i]['height'] = image.Pixels.SizeY
-        metadata_dict[i]['channels'] = image.Pixels.channel_count
-
-    image = metadata.image(0)
-    for i in range(image.Pixels.channel_count):
-        metadata_dict[f'channel_{i}_name'] = image.Pixels.channel(i).Name
-
+    if use_cache:
+        save_cached_metadata(infile, metadata_dict)
     return metadata_dict
 
 
@@ -0,0 +1,440 @@
+"""
+Memory bounded cleaning of the full resolution sections. This gives the same result
+as fix_ntb in create_clean.py (mask, scale, CLAHE, rotate, flip and place in the
+padded container) without ever holding the whole section in memory.
+
+The source tif is memory mapped and every step is done on one block at a time in the
+source data type. The output is written as a tiled, deflate compressed TIFF, one
+tile at a time:
+
+1. Rotating and flipping a pair of broadcast index grids (views, no memory) tells
+   which block of the source ends up in an output tile.
+2. The block is masked and, for channel 1, scaled with a lookup table and equalized.
+3. The block is rotated and flipped like the whole section would be and put in the tile.
+
+For channel 1 the scaling needs the 99th percentile of the tissue and CLAHE needs the
+histogram of every CLAHE tile. Both come from one pass over the source in strips,
+then the CLAHE lookup tables are built like OpenCV does (BORDER_REFLECT_101 padding,
+clip limit, redistribution and bilinear interpolation between tiles), so the result
+matches cv2.createCLAHE(clipLimit=10.0, tileGridSize=(8, 8)).apply().
+With a step above 1 the histograms come from every step-th row and column only,
+which is much less reading and counting for a close but not exact result.
+"""
+import os
+import numpy as np
+import tifffile
+
+from lib.utilities_packed_mask import PackedMask, get_packed_path, load_mask
+from lib.utilities_virtual_mask import VirtualMask
+from lib.utilities_stats import get_quantile
+
+CLAHE_CLIP_LIMIT = 10.0
+CLAHE_TILES = (8, 8)
+BLOCK_SIZE = 1024
+STRIP_BYTES = 64 * 1024 * 1024
+MASK_THRESHOLD = 10
+DEFLATE_LEVEL = 6
+# largest section written as classic TIFF, PIL in process_image does not read BigTIFF
+BIGTIFF_BYTES = 2**32 - 2**25
+
+
+class ArrayMask:
+    """
+    A mask that is already in memory or memory mapped, with the same rows interface
+    as VirtualMask and PackedMask
+    """
+
+    def __init__(self, mask):
+        self.mask = mask
+        self.shape = mask.shape
+
+    def rows(self, start, stop, col0=0, col1=None):
+        return np.asarray(self.mask[start:stop, col0:col1])
+
+
+def get_tiled_memory(width, height):
+    """
+    Rough peak memory of clean_tiled and clean_aligned for one section. The section and
+    its 8 bit mask are memory maps, the masks handed out only cover one strip or block.
+    :return: bytes of a few strips of codes in scan_histograms or a few int64 copies of a
+        block, whichever is more, plus the CLAHE tables and a packed mask of one bit a pixel
+    """
+    blocks = 16 * 8 * BLOCK_SIZE * BLOCK_SIZE
+    luts = CLAHE_TILES[0] * CLAHE_TILES[1] * 2 ** 16 * 2
+    return max(4 * STRIP_BYTES, blocks) + luts + -(-int(width) * int(height) // 8)
+
+
+def open_image(filepath):
+    """
+    Memory maps the first page of a tif. Compressed tifs are decoded into a
+    temporary memory map on disk first.
+    :param filepath: path of the tif
+    :return: 2D memory map
+    """
+    with tifffile.TiffFile(filepath) as tif:
+        page = tif.pages[0]
+        if not page.is_memmappable:
+            return page.asarray(out='memmap')
+    return tifffile.memmap(filepath, page=0, mode='r')
+
+
+def get_mask_provider(maskfile, width, height, virtual=False):
+    """
+    :param maskfile: path of the mask
+    :param width: width of the section
+    :param height: height of the section
+    :param virtual: True if maskfile is a thumbnail mask to upsample
+    :return: object with a rows(start, stop, col0, col1) method
+    """
+    if virtual:
+        return VirtualMask(maskfile, width, height)
+    packed_path = get_packed_path(maskfile)
+    if os.path.exists(packed_path):
+        return PackedMask(packed_path)
+    try:
+        return ArrayMask(open_image(maskfile))
+    except (OSError, ValueError):
+        mask = load_mask(maskfile)
+        if mask is None:
+            raise OSError(f'Mask {maskfile} does not exist')
+        return ArrayMask(mask)
+
+
+def get_clahe_geometry(height, width, tiles=CLAHE_TILES):
+    """
+    OpenCV pads the image on the bottom and right with BORDER_REFLECT_101 when it
+    does not divide into the tiles, and then it pads both directions.
+    :return: tuple of bottom padding, right padding, tile height and tile width
+    """
+    tiles_x, tiles_y = tiles
+    if height % tiles_y == 0 and width % tiles_x == 0:
+        pad_rows, pad_cols = 0, 0
+    else:
+        pad_rows = tiles_y - height % tiles_y
+        pad_cols = tiles_x - width % tiles_x
+    return pad_rows, pad_cols, (height + pad_rows) // tiles_y, (width + pad_cols) // tiles_x
+
+
+def get_codes(img_rows, mask_rows, n_values):
+    """
+    The value every pixel has after masking, with the pixels under the
+    threshold of the mask put in an extra bin n_values.
+    """
+    return np.where(mask_rows > MASK_THRESHOLD, img_rows.astype(np.int64), n_values)
+
+
+def scan_histograms(img, mask, tiles=CLAHE_TILES, strip_bytes=STRIP_BYTES):
+    """
+    One pass over the section that gets both the histogram of the tissue and the
+    histogram of every CLAHE tile of the padded section.
+    :param img: 2D memory map of the section
+    :param mask: mask provider
+    :return: tuple of tissue histogram (n_values,) and tile histograms
+        (tiles_y, tiles_x, n_values + 1), the last bin counts the pixels outside the tissue
+    """
+    height, width = img.shape
+    tiles_x, tiles_y = tiles
+    n_values = np.iinfo(img.dtype).max + 1
+    pad_rows, pad_cols, tile_h, tile_w = get_clahe_geometry(height, width, tiles)
+    padded_cols = np.concatenate([np.arange(width), width - 2 - np.arange(pad_cols)])
+    col_offsets = (np.arange(width + pad_cols) // tile_w) * (n_values + 1)
+    # the padded rows at the bottom are copies of these rows and belong to the last tile row
+    mirrored = {height - 2 - k for k in range(pad_rows)}
+
+    tissue = np.zeros(n_values, dtype=np.int64)
+    tile_hists = np.zeros((tiles_y, tiles_x * (n_values + 1)), dtype=np.int64)
+    strip_rows = max(1, strip_bytes // ((width + pad_cols) * 8))
+    for row in range(0, height, strip_rows):
+        stop = min(row + strip_rows, height)
+        codes = get_codes(np.asarray(img[row:stop]), mask.rows(row, stop), n_values)
+        tissue += np.bincount(codes.ravel(), minlength=n_values + 1)[:n_values]
+        codes = codes[:, padded_cols] + col_offsets
+        tile_rows = np.arange(row, stop) // tile_h
+        for ty in np.unique(tile_rows):
+            tile_hists[ty] += np.bincount(codes[tile_rows == ty].ravel(), minlength=tile_hists.shape[1])
+        for r in mirrored:
+            if row <= r < stop:
+                tile_hists[tiles_y - 1] += np.bincount(codes[r - row], minlength=tile_hists.shape[1])
+    return tissue, tile_hists.reshape(tiles_y, tiles_x, n_values + 1)
+
+
+def sample_histograms(img, mask, step, tiles=CLAHE_TILES, strip_bytes=STRIP_BYTES):
+    """
+    Same as scan_histograms from every step-th row and column only. The counts are
+    scaled so they stand for the whole section, and the padded rows and columns are
+    left out.
+    :param img: 2D memory map or array of the section
+    :param mask: mask provider or None to count every pixel as tissue
+    :param step: distance between the sampled rows and columns
+    :return: tuple of tissue histogram (n_values,) and tile histograms (tiles_y, tiles_x, n_values + 1)
+    """
+    height, width = img.shape
+    tiles_x, tiles_y = tiles
+    n_values = np.iinfo(img.dtype).max + 1
+    _, _, tile_h, tile_w = get_clahe_geometry(height, width, tiles)
+    sample_rows = np.arange(step // 2, height, step)
+    sample_cols = np.arange(step // 2, width, step)
+    col_offsets = (sample_cols // tile_w) * (n_values + 1)
+
+    tissue = np.zeros(n_values, dtype=np.int64)
+    tile_hists = np.zeros((tiles_y, tiles_x * (n_values + 1)), dtype=np.int64)
+    strip_rows = max(1, strip_bytes // (len(sample_cols) * 8))
+    for i in range(0, len(sample_rows), strip_rows):
+        rows = sample_rows[i:i + strip_rows]
+        img_rows = np.asarray(img[rows[0]:rows[-1] + 1:step])[:, sample_cols]
+        if mask is None:
+            codes = img_rows.astype(np.int64)
+        else:
+            mask_rows = np.vstack([mask.rows(r, r + 1) for r in rows])[:, sample_cols]
+            codes = get_codes(img_rows, mask_rows, n_values)
+        tissue += np.bincount(codes.ravel(), minlength=n_values + 1)[:n_values]
+        codes = codes + col_offsets
+        tile_rows = rows // tile_h
+        for ty in np.unique(tile_rows):
+            tile_hists[ty] += np.bincount(codes[tile_rows == ty].ravel(), minlength=tile_hists.shape[1])
+    # a sample has too few pixels for the single values, they are counted in bins of about
+    # step * step values and spread evenly over the values of the bin
+    bin_width = min(2 ** int(np.log2(step * step)), n_values)
+    tissue = spread_histogram(tissue, bin_width) * step * step
+    tile_hists = tile_hists.reshape(tiles_y, tiles_x, n_values + 1).astype(np.float64)
+    tile_hists[..., :n_values] = spread_histogram(tile_hists[..., :n_values], bin_width)
+    # every tile stands for tile_h * tile_w pixels, the padded ones included
+    totals = tile_hists.sum(axis=2, keepdims=True)
+    tile_hists *= tile_h * tile_w / np.maximum(totals, 1)
+    return np.rint(tissue).astype(np.int64), np.rint(tile_hists).astype(np.int64)
+
+
+def spread_histogram(hist, bin_width):
+    """
+    :param hist: histograms along the last axis, the length is a multiple of bin_width
+    :return: the histograms with the counts of every bin_width values spread evenly over them
+    """
+    shape = hist.shape
+    bins = hist.reshape(shape[:-1] + (shape[-1] // bin_width, bin_width)).sum(axis=-1, keepdims=True)
+    return np.broadcast_to(bins / bin_width, shape[:-1] + (shape[-1] // bin_width, bin_width)).reshape(shape)
+
+
+def get_scale_lut(n_values, scale, _max):
+    """
+    The scaled() function of utilities_mask as a lookup table
+    :return: lookup table from the masked value to the scaled value
+    """
+    if scale > 255:
+        _range = 2 ** 16 - 1 # 16bit
+        data_type = np.uint16
+    else:
+        _range = 2 ** 256 - 1 # 8bit
+        data_type = np.uint8
+    scaled = np.arange(n_values) * (scale / _max)
+    scaled[scaled > _range] = _range
+    return scaled.astype(data_type)
+
+
+def get_clahe_luts(tile_hists, tile_size, clip_limit=CLAHE_CLIP_LIMIT, dtype=np.uint16):
+    """
+    The lookup table of every CLAHE tile, computed the way OpenCV does.
+    :param tile_hists: (tiles_y, tiles_x, hist_size) histograms of the tiles
+    :param tile_size: number of pixels in one tile
+    :param clip_limit: the clipLimit given to cv2.createCLAHE
+    :param dtype: data type of the image
+    :return: (tiles_y, tiles_x, hist_size) lookup tables
+    """
+    hist_size = tile_hists.shape[-1]
+    clip = 0
+    if clip_limit > 0:
+        clip = max(int(clip_limit * tile_size / hist_size), 1)
+    lut_scale = np.float32(hist_size - 1) / np.float32(tile_size)
+    luts = np.empty(tile_hists.shape, dtype=dtype)
+    for index in np.ndindex(tile_hists.shape[:-1]):
+        hist = tile_hists[index].astype(np.int64)
+        if clip > 0:
+            clipped = int(np.maximum(hist - clip, 0).sum())
+            hist = np.minimum(hist, clip)
+            redist_batch = clipped // hist_size
+            residual = clipped - redist_batch * hist_size
+            hist += redist_batch
+            if residual != 0:
+                residual_step = max(hist_size // residual, 1)
+                hist[np.arange(0, hist_size, residual_step)[:residual]] += 1
+        cumulative = np.cumsum(hist).astype(np.float32) * lut_scale
+        luts[index] = np.clip(np.rint(cumulative), 0, np.iinfo(dtype).max)
+    return luts
+
+
+def get_interpolation(start, stop, tile, n_tiles):
+    """
+    Tile indices and weights of pixels start to stop along one axis, as in OpenCV
+    :return: tuple of first tile, second tile, weight of the first tile, weight of the second tile
+    """
+    inv = np.float32(1.0) / np.float32(tile)
+    f = np.arange(start, stop).astype(np.float32) * inv - np.float32(0.5)
+    t1 = np.floor(f).astype(np.int64)
+    a = f - t1.astype(np.float32)
+    a1 = np.float32(1.0) - a
+    t2 = np.minimum(t1 + 1, n_tiles - 1)
+    t1 = np.maximum(t1, 0)
+    return t1, t2, a1, a
+
+
+def apply_clahe(block, row, col, luts, tile_h, tile_w):
+    """
+    Equalizes one block of the section with the lookup tables of the whole section
+    :param block: 2D block of the section
+    :param row: row of the block in the section
+    :param col: column of the block in the section
+    :param luts: lookup tables from get_clahe_luts
+    :return: the equalized block
+    """
+    tiles_y, tiles_x, hist_size = luts.shape
+    ty1, ty2, ya1, ya = get_interpolation(row, row + block.shape[0], tile_h, tiles_y)
+    tx1, tx2, xa1, xa = get_interpolation(col, col + block.shape[1], tile_w, tiles_x)
+    flat = luts.reshape(-1)
+    values = block.astype(np.int64)
+    plane1 = (ty1 * tiles_x)[:, None] * hist_size + values
+    plane2 = (ty2 * tiles_x)[:, None] * hist_size + values
+    ind1 = (tx1 * hist_size)[None, :]
+    ind2 = (tx2 * hist_size)[None, :]
+    xa1 = xa1[None, :]
+    xa = xa[None, :]
+    res = (flat[plane1 + ind1] * xa1 + flat[plane1 + ind2] * xa) * ya1[:, None] + \
+          (flat[plane2 + ind1] * xa1 + flat[plane2 + ind2] * xa) * ya[:, None]
+    return np.clip(np.rint(res), 0, np.iinfo(luts.dtype).max).astype(luts.dtype)
+
+
+def transform(img, rotation, flip):
+    """
+    Same rotation and flip as fix_ntb
+    """
+    if rotation > 0:
+        img = np.rot90(img, rotation, axes=(1, 0))
+    if flip == 'flip':
+        img = np.flip(img)
+    if flip == 'flop':
+        img = np.flip(img, axis=1)
+    return img
+
+
+def clean_block(img, mask, row, stop, col, end, scale_lut=None, luts=None, tile_h=None, tile_w=None):
+    """
+    Masks, and for channel 1 scales and equalizes, one block of the section
+    :return: the cleaned block in the source data type
+    """
+    block = np.asarray(img[row:stop, col:end])
+    mask_rows = mask.rows(row, stop, col, end)
+    block = np.where(mask_rows != 0, block, 0).astype(img.dtype)
+    if scale_lut is not None:
+        block = np.where(mask_rows > MASK_THRESHOLD, scale_lut[block], 0).astype(scale_lut.dtype)
+        block = apply_clahe(block, row, col, luts, tile_h, tile_w)
+    return block
+
+
+def get_cleaning_luts(img, mask, channel, scale, step=1):
+    """
+    The lookup tables of the scaling and the CLAHE of channel 1, from one pass over the section.
+    :param step: 1 to use every pixel, which matches OpenCV exactly, or n to build the
+        tables from every nth row and column, see sample_histograms
+    :return: tuple of scale lookup table, CLAHE lookup tables, CLAHE tile height and width,
+        all None for the other channels which are only masked
+    """
+    if channel != 1:
+        return None, None, None, None
+    height, width = img.shape
+    if step > 1:
+        tissue, tile_hists = sample_histograms(img, mask, step)
+    else:
+        tissue, tile_hists = scan_histograms(img, mask)
+    _max = get_quantile(tissue, 1 - 0.01)
+    scale_lut = get_scale_lut(len(tissue), scale, _max)
+    hist_size = np.iinfo(scale_lut.dtype).max + 1
+    # the histograms of the scaled tiles follow from the histograms of the source values
+    lut = np.append(scale_lut, 0).astype(np.int64)
+    tile_hists = np.apply_along_axis(
+        lambda h: np.bincount(lut, weights=h, minlength=hist_size), 2, tile_hists).astype(np.int64)
+    _, _, tile_h, tile_w = get_clahe_geometry(height, width)
+    luts = get_clahe_luts(tile_hists, tile_h * tile_w, dtype=scale_lut.dtype)
+    return scale_lut, luts, tile_h, tile_w
+
+
+def clean_sampled(img, mask, scale, step):
+    """
+    Masks, scales and equalizes a whole channel 1 section that is in memory, for fix_ntb.
+    The lookup tables are the ones of clean_tiled built from every step-th row and column,
+    and the section is cleaned a strip at a time.
+    :param img: 2D section
+    :param mask: 2D mask of the section or mask provider
+    :param scale: used in scaling, see scaled() in utilities_mask
+    :param step: distance between the sampled rows and columns
+    :return: the cleaned section
+    """
+    if isinstance(mask, np.ndarray):
+        mask = ArrayMask(mask)
+    height, width = img.shape
+    scale_lut, luts, tile_h, tile_w = get_cleaning_luts(img, mask, 1, scale, step)
+    fixed = np.empty((height, width), dtype=scale_lut.dtype)
+    strip_rows = max(1, STRIP_BYTES // (width * 8))
+    for row in range(0, height, strip_rows):
+        stop = min(row + strip_rows, height)
+        fixed[row:stop] = clean_block(img, mask, row, stop, 0, width, scale_lut, luts, tile_h, tile_w)
+    return fixed
+
+
+def get_placement(infile, shape, rotation, flip, max_width, max_height):
+    """
+    Where the rotated and flipped section goes in the padded container, as place_image does it
+    :param shape: (height, width) of the source section
+    :return: tuple of the rotated and flipped row and column index grids (views, no memory),
+        the first row and column of the section in the container, and False if it does not fit
+    """
+    height, width = shape
+    # the rotated and flipped index grids give the source pixel of every placed pixel
+    rows = transform(np.broadcast_to(np.arange(height)[:, None], (height, width)), rotation, flip)
+    cols = transform(np.broadcast_to(np.arange(width)[None, :], (height, width)), rotation, flip)
+    placed_height, placed_width = rows.shape
+    startr = max_height // 2 - placed_height // 2
+    startc = max_width // 2 - placed_width // 2
+    fits = startr >= 0 and startc >= 0 and startr + placed_height <= max_height \
+        and startc + placed_width <= max_width
+    if not fits:
+        print('Could not place {} with width:{}, height:{} in {}x{}'
+              .format(infile, placed_width, placed_height, max_width, max_height))
+    return rows, cols, startr, startc, fits
+
+
+def clean_tiled(file_key, mask=None, step=1):
+    """
+    Memory bounded version of fix_ntb for the full resolution NTB sections.
+    file_key is the same tuple as for fix_ntb.
+    :param mask: mask provider already opened by clean_channels, opened from the maskfile when None
+    :param step: 1 for the exact CLAHE of channel 1, n to build its tables from every nth row and column
+    :return: nothing. we write the image to disk
+    """
+    infile, outpath, maskfile, rotation, flip, max_width, max_height, scale, channel, virtual = file_key
+    img = open_image(infile)
+    height, width = img.shape
+    if mask is None:
+        mask = get_mask_provider(maskfile, width, height, virtual)
+
+    scale_lut, luts, tile_h, tile_w = get_cleaning_luts(img, mask, channel, scale, step)
+    dtype = img.dtype if scale_lut is None else scale_lut.dtype
+    rows, cols, startr, startc, fits = get_placement(infile, img.shape, rotation, flip, max_width, max_height)
+    placed_height, placed_width = rows.shape
+
+    def tiles():
+        for r in range(0, max_height, BLOCK_SIZE):
+            for c in range(0, max_width, BLOCK_SIZE):
+                tile = np.zeros((BLOCK_SIZE, BLOCK_SIZE), dtype=dtype)
+                i0, i1 = max(r - startr, 0), min(r + BLOCK_SIZE - startr, placed_height)
+                j0, j1 = max(c - startc, 0), min(c + BLOCK_SIZE - startc, placed_width)
+                if fits and i1 > i0 and j1 > j0:
+                    corners_r = (rows[i0, j0], rows[i1 - 1, j1 - 1])
+                    corners_c = (cols[i0, j0], cols[i1 - 1, j1 - 1])
+                    block = clean_block(img, mask, min(corners_r), max(corners_r) + 1,
+                                        min(corners_c), max(corners_c) + 1, scale_lut, luts, tile_h, tile_w)
+                    block = transform(block, rotation, flip)
+                    tile[i0 + startr - r:i1 + startr - r, j0 + startc - c:j1 + startc - c] = block
+                yield tile
+
+    tifffile.imwrite(outpath, tiles(), shape=(max_height, max_width), dtype=dtype,
+                     tile=(BLOCK_SIZE, BLOCK_SIZE), compress=DEFLATE_LEVEL,
+                     bigtiff=max_height * max_width * np.dtype(dtype).itemsize > BIGTIFF_BYTES)
+    del img
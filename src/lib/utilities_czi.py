@@ -0,0 +1,299 @@
+"""
+In process reading of the CZI files with czifile. This replaces running the
+bioformats bfconvert tool once per scene and channel. The subblock directory
+of the CZI is parsed once and every subblock of the requested scenes is decoded
+one at a time and copied into a memory mapped BigTIFF per scene and channel, so
+the memory used stays at about one subblock no matter how big the scene is.
+
+The series numbering follows bioformats: every scene has one series
+per pyramid level (full resolution first) and the label and macro images
+come after all the scenes. This is the scene_index stored in the
+slide_czi_to_tif table by create_meta.py.
+
+The pyramid levels are used to make the thumbnails without decoding the
+full resolution subblocks.
+
+extract_czi can also make the thumbnail and the web png of each scene while the
+freshly written BigTIFF is still in the page cache, so the pixels are decoded once
+for all three files.
+"""
+import os
+import traceback
+import cv2
+import numpy as np
+import tifffile
+from czifile import CziFile
+
+from lib.utilities_thumbnail import get_thumbnail_size, contrast_stretch, area_downsample, get_row_strips
+from lib.utilities_journal import get_temp_path, remove_file, get_file_record
+
+
+def get_dimension(directory_entry, dimension):
+    """
+    Finds a dimension entry of a subblock
+    :param directory_entry: DirectoryEntryDV of a subblock
+    :param dimension: one letter dimension, e.g., X, Y, C, S
+    :return: DimensionEntryDV1 or None if the subblock does not have that dimension
+    """
+    for dimension_entry in directory_entry.dimension_entries:
+        if dimension_entry.dimension == dimension:
+            return dimension_entry
+    return None
+
+
+def get_start(directory_entry, dimension):
+    dimension_entry = get_dimension(directory_entry, dimension)
+    if dimension_entry is None:
+        return 0
+    return dimension_entry.start
+
+
+def get_pyramid_factor(directory_entry):
+    """
+    Full resolution subblocks have a stored size equal to their size. Pyramid
+    subblocks are stored smaller than the area they cover.
+    :param directory_entry: DirectoryEntryDV of a subblock
+    :return: integer downsampling factor of the subblock, 1 is full resolution
+    """
+    x = get_dimension(directory_entry, 'X')
+    return int(round(x.size / x.stored_size))
+
+
+def get_series_layout(czi):
+    """
+    Groups the subblocks of the czi by scene and pyramid level.
+    :param czi: an open CziFile
+    :return: list indexed by the bioformats series number. Each item is a dictionary with
+        the scene, the pyramid factor, the scene origin and size in full resolution pixels,
+        and the subblock directory entries for that scene and level.
+    """
+    scenes = {}
+    for directory_entry in czi.subblock_directory:
+        scene = get_start(directory_entry, 'S')
+        factor = get_pyramid_factor(directory_entry)
+        scenes.setdefault(scene, {}).setdefault(factor, []).append(directory_entry)
+
+    layout = []
+    for scene in sorted(scenes):
+        levels = scenes[scene]
+        fullres = levels[min(levels)]
+        x0 = min(get_start(e, 'X') for e in fullres)
+        y0 = min(get_start(e, 'Y') for e in fullres)
+        x1 = max(get_start(e, 'X') + get_dimension(e, 'X').size for e in fullres)
+        y1 = max(get_start(e, 'Y') + get_dimension(e, 'Y').size for e in fullres)
+        for factor in sorted(levels):
+            entries = sorted(levels[factor], key=lambda e: (e.mosaic_index is None, e.mosaic_index, e.file_position))
+            layout.append({'scene': scene, 'factor': factor, 'x': x0, 'y': y0,
+                           'width': x1 - x0, 'height': y1 - y0, 'entries': entries})
+    return layout
+
+
+def read_subblock(directory_entry):
+    """
+    Decodes one subblock without resizing.
+    :param directory_entry: DirectoryEntryDV of a subblock
+    :return: tuple of x, y, channels where channels is a list of 2D arrays, one per channel
+        and x, y is the position of the subblock in full resolution pixels
+    """
+    tile = directory_entry.data_segment().data(resize=False)
+    stored_height = get_dimension(directory_entry, 'Y').stored_size
+    stored_width = get_dimension(directory_entry, 'X').stored_size
+    samples = tile.shape[-1]
+    tile = tile.reshape(stored_height, stored_width, samples)
+    x = get_start(directory_entry, 'X')
+    y = get_start(directory_entry, 'Y')
+    if samples > 1:
+        channels = [tile[:, :, i] for i in range(samples)]
+    else:
+        channels = [tile[:, :, 0]]
+    return x, y, channels
+
+
+def get_subblock_channel(directory_entry, channel_index, channel):
+    """
+    :param directory_entry: DirectoryEntryDV of a subblock
+    :param channel_index: index of the channel within the decoded subblock
+    :param channel: 0 based channel wanted
+    :return: True if this subblock data belongs to the channel wanted
+    """
+    if directory_entry.shape[-1] > 1:
+        return channel_index == channel
+    return get_start(directory_entry, 'C') == channel
+
+
+def paste(out, x, y, data):
+    """
+    Copies a tile into the output, clipping anything outside of it.
+    :param out: 2D output array or memmap
+    :param x: column of the tile in the output
+    :param y: row of the tile in the output
+    :param data: 2D tile
+    """
+    height, width = out.shape[:2]
+    r0 = max(y, 0)
+    c0 = max(x, 0)
+    r1 = min(y + data.shape[0], height)
+    c1 = min(x + data.shape[1], width)
+    if r1 <= r0 or c1 <= c0:
+        return
+    out[r0:r1, c0:c1] = data[r0 - y:r1 - y, c0 - x:c1 - x]
+
+
+def write_image(filepath, img):
+    """
+    Writes an image with OpenCV to a temporary file and moves it into place when complete
+    """
+    temp_path = get_temp_path(filepath)
+    cv2.imwrite(temp_path, img)
+    os.replace(temp_path, filepath)
+
+
+def write_thumbnails(out, thumbnail_path, png_path, scaling_factor):
+    """
+    Area averages a scene that was just written into the thumbnail and the web png.
+    :param out: 2D memory map of the full resolution scene
+    :param thumbnail_path: file path of the thumbnail or None
+    :param png_path: file path of the png or None
+    :param scaling_factor: e.g., 0.03125
+    """
+    height, width = out.shape
+    out_width, out_height = get_thumbnail_size(width, height, scaling_factor)
+    img = area_downsample(get_row_strips(out), height, width, out_height, out_width, dtype=out.dtype)
+    if thumbnail_path is not None:
+        write_image(thumbnail_path, img)
+    if png_path is not None:
+        write_image(png_path, contrast_stretch(img))
+
+
+def extract_czi(file_key):
+    """
+    Opens a czi file once and writes every requested scene/channel to its own
+    BigTIFF in a single pass over the subblocks. This is the worker used by the pool.
+    The BigTIFFs are written to temporary files and moved to the output paths when complete.
+    A czi or an output that cannot be made is reported and its temporary files are removed.
+    file_key is a tuple of the following:
+        :param czi_file: file path of the czi
+        :param outputs: list of (scene_index, channel_index, output_path, thumbnail_path, png_path),
+            scene_index is the bioformats series and channel_index is 0 based like bfconvert -channel.
+            thumbnail_path and png_path are None when they are not wanted
+        :param scaling_factor: e.g., 0.03125 for the thumbnails
+    :return: list of (output path, size, checksum) of the tifs that were written, for the journal,
+        even when the czi failed part way
+    """
+    czi_file, outputs, scaling_factor = file_key
+    written = []
+    tifs = {}
+    try:
+        with CziFile(czi_file) as czi:
+            layout = get_series_layout(czi)
+            dtype = czi.dtype
+            scenes = set()
+            for scene_index, channel_index, output_path, thumbnail_path, png_path in outputs:
+                if scene_index >= len(layout):
+                    print(f'{czi_file} does not have a series {scene_index}')
+                    continue
+                series = layout[scene_index]
+                temp_path = get_temp_path(output_path)
+                remove_file(temp_path)
+                tifs[(scene_index, channel_index)] = (series, output_path, thumbnail_path, png_path,
+                    tifffile.memmap(temp_path, shape=(series['height'], series['width']),
+                                    dtype=dtype, bigtiff=True))
+                scenes.add(scene_index)
+
+            # one read of each subblock serves all the channels that want it. The subblocks are pasted
+            # in the mosaic_index order of get_series_layout so overlapping tiles end up like bfconvert
+            subblocks = [(scene_index, directory_entry) for scene_index in sorted(scenes)
+                         for directory_entry in layout[scene_index]['entries']]
+            for scene_index, directory_entry in subblocks:
+                x, y, channels = read_subblock(directory_entry)
+                for i, data in enumerate(channels):
+                    for (tif_scene, tif_channel), (series, _, _, _, out) in tifs.items():
+                        if tif_scene != scene_index or not get_subblock_channel(directory_entry, i, tif_channel):
+                            continue
+                        paste(out, x - series['x'], y - series['y'], data)
+                del channels
+
+        for key in list(tifs):
+            series, output_path, thumbnail_path, png_path, out = tifs.pop(key)
+            temp_path = out.filename
+            try:
+                out.flush()
+                if thumbnail_path is not None or png_path is not None:
+                    write_thumbnails(out, thumbnail_path, png_path, scaling_factor)
+                del out
+                os.replace(temp_path, output_path)
+                written.append(get_file_record(output_path))
+            except Exception:
+                print(f'Could not write {output_path} from {czi_file}')
+                print(traceback.format_exc())
+                remove_file(temp_path)
+    except Exception:
+        print(f'Could not extract {czi_file}')
+        print(traceback.format_exc())
+    finally:
+        # the scenes that were not finished leave no temporary files behind
+        for key in list(tifs):
+            temp_path = tifs.pop(key)[-1].filename
+            remove_file(temp_path)
+    return written
+
+
+def read_pyramid_level(layout, scene_index, channel_index, scaling_factor):
+    """
+    Reads the scene from the smallest pyramid level that is still at least as
+    big as the thumbnail, so only the last small resize is left to do. The full
+    resolution subblocks are never decoded unless the czi has no pyramid.
+    :param layout: list from get_series_layout
+    :param scene_index: bioformats series of the full resolution scene
+    :param channel_index: 0 based channel
+    :param scaling_factor: e.g., 0.03125
+    :return: tuple of the 2D image at the pyramid level and the full resolution series
+    """
+    fullres = layout[scene_index]
+    wanted = 1 / scaling_factor
+    levels = [series for series in layout if series['scene'] == fullres['scene'] and series['factor'] <= wanted]
+    series = max(levels, key=lambda s: s['factor'])
+    factor = series['factor']
+    height = -(-series['height'] // factor)
+    width = -(-series['width'] // factor)
+    img = None
+    for directory_entry in series['entries']:
+        x, y, channels = read_subblock(directory_entry)
+        for i, data in enumerate(channels):
+            if not get_subblock_channel(directory_entry, i, channel_index):
+                continue
+            if img is None:
+                img = np.zeros((height, width), dtype=data.dtype)
+            paste(img, (x - series['x']) // factor, (y - series['y']) // factor, data)
+    return img, fullres
+
+
+def make_czi_thumbnails(file_key):
+    """
+    Creates the thumbnails and web pngs of one czi file from its pyramid levels.
+    This is the worker used by the pool.
+    file_key is a tuple of the following:
+        :param czi_file: file path of the czi
+        :param outputs: list of (scene_index, channel_index, thumbnail_paths, png_path),
+            thumbnail_paths is a list as replicated sections need the same thumbnail more
+            than once and png_path can be None
+        :param scaling_factor: e.g., 0.03125
+    :return: nothing, we write the images to disk
+    """
+    czi_file, outputs, scaling_factor = file_key
+    with CziFile(czi_file) as czi:
+        layout = get_series_layout(czi)
+        for scene_index, channel_index, thumbnail_paths, png_path in outputs:
+            if scene_index >= len(layout):
+                print(f'{czi_file} does not have a series {scene_index}')
+                continue
+            img, fullres = read_pyramid_level(layout, scene_index, channel_index, scaling_factor)
+            if img is None:
+                print(f'{czi_file} series {scene_index} has no channel {channel_index}')
+                continue
+            size = get_thumbnail_size(fullres['width'], fullres['height'], scaling_factor)
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            for thumbnail_path in thumbnail_paths:
+                write_image(thumbnail_path, img)
+            if png_path is not None:
+                write_image(png_path, contrast_stretch(img))
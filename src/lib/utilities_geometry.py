@@ -0,0 +1,104 @@
+"""
+Cleaning and aligning a full resolution section in one resampling pass.
+
+The rotation and flip of the scan run, the centring in the padded container and the
+section to section alignment T from elastix are all affine, so they compose into one
+3x3 matrix per section. That matrix takes the centre of every aligned pixel straight
+to the source pixel it comes from, and the pixel is taken with nearest neighbour like
+process_image does with PIL's Image.NEAREST. The full_cleaned images are never written:
+clean_aligned masks, scales and equalizes only the source pixels it needs, a tile of
+the aligned section at a time, and writes the tile to full_aligned.
+
+All the matrices work on (x, y, 1) column vectors, x is the column and y the row.
+"""
+import numpy as np
+import tifffile
+
+from lib.utilities_clean import BLOCK_SIZE, DEFLATE_LEVEL, BIGTIFF_BYTES, open_image, get_mask_provider, \
+    get_cleaning_luts, get_placement, clean_block
+
+# from pixel indices to coordinates where the pixel centres are at +0.5
+HALF_PIXEL = np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+
+
+def get_placement_matrix(rows, cols, startr, startc):
+    """
+    The rotation, flip and placement as an affine map of pixel indices
+    :param rows: rotated and flipped row index grid from get_placement
+    :param cols: rotated and flipped column index grid from get_placement
+    :param startr: first row of the section in the container
+    :param startc: first column of the section in the container
+    :return: 3x3 integer matrix from the (x, y) index in the container to the (x, y) index in the source
+    """
+    origin = np.array([cols[0, 0], rows[0, 0]])
+    step_x = np.array([cols[0, 1], rows[0, 1]]) - origin
+    step_y = np.array([cols[1, 0], rows[1, 0]]) - origin
+    placed = np.vstack([np.column_stack([step_x, step_y, origin]), [0, 0, 1]])
+    shift = np.array([[1, 0, -startc], [0, 1, -startr], [0, 0, 1]])
+    return placed @ shift
+
+
+def get_section_transform(placement, T):
+    """
+    Composes the cleaning geometry with the alignment
+    :param placement: matrix from get_placement_matrix
+    :param T: the matrix given to PIL by process_image, from the aligned pixel to the cleaned pixel
+    :return: 3x3 matrix from the centre of an aligned pixel to the source, the source pixel
+        is the floor of the result
+    """
+    return HALF_PIXEL @ placement @ np.linalg.inv(HALF_PIXEL) @ T
+
+
+def get_source_pixels(A, row, stop, col, end):
+    """
+    :param A: matrix from get_section_transform
+    :return: tuple of the source rows and columns of the aligned pixels in rows row to stop
+        and columns col to end
+    """
+    y = np.arange(row, stop, dtype=np.float64)[:, None] + 0.5
+    x = np.arange(col, end, dtype=np.float64)[None, :] + 0.5
+    source_cols = np.floor(A[0, 0] * x + A[0, 1] * y + A[0, 2]).astype(np.int64)
+    source_rows = np.floor(A[1, 0] * x + A[1, 1] * y + A[1, 2]).astype(np.int64)
+    return source_rows, source_cols
+
+
+def clean_aligned(file_key, mask=None, step=1):
+    """
+    Cleans and aligns one full resolution section. This is clean_tiled followed by
+    process_image without the full_cleaned image in between.
+    file_key is the tuple of fix_ntb followed by the matrix T of process_image
+    :param mask: mask provider already opened by clean_channels, opened from the maskfile when None
+    :param step: 1 for the exact CLAHE of channel 1, n to build its tables from every nth row and column
+    :return: nothing. we write the image to disk
+    """
+    infile, outpath, maskfile, rotation, flip, max_width, max_height, scale, channel, virtual, T = file_key
+    img = open_image(infile)
+    height, width = img.shape
+    if mask is None:
+        mask = get_mask_provider(maskfile, width, height, virtual)
+
+    scale_lut, luts, tile_h, tile_w = get_cleaning_luts(img, mask, channel, scale, step)
+    dtype = img.dtype if scale_lut is None else scale_lut.dtype
+    rows, cols, startr, startc, fits = get_placement(infile, img.shape, rotation, flip, max_width, max_height)
+    A = get_section_transform(get_placement_matrix(rows, cols, startr, startc), np.asarray(T, dtype=np.float64))
+
+    def tiles():
+        for r in range(0, max_height, BLOCK_SIZE):
+            for c in range(0, max_width, BLOCK_SIZE):
+                tile = np.zeros((BLOCK_SIZE, BLOCK_SIZE), dtype=dtype)
+                if fits:
+                    source_rows, source_cols = get_source_pixels(A, r, min(r + BLOCK_SIZE, max_height),
+                                                                 c, min(c + BLOCK_SIZE, max_width))
+                    inside = (source_rows >= 0) & (source_rows < height) & (source_cols >= 0) & (source_cols < width)
+                    if inside.any():
+                        source_rows, source_cols = source_rows[inside], source_cols[inside]
+                        row, col = source_rows.min(), source_cols.min()
+                        block = clean_block(img, mask, row, source_rows.max() + 1, col, source_cols.max() + 1,
+                                            scale_lut, luts, tile_h, tile_w)
+                        tile[:inside.shape[0], :inside.shape[1]][inside] = block[source_rows - row, source_cols - col]
+                yield tile
+
+    tifffile.imwrite(outpath, tiles(), shape=(max_height, max_width), dtype=dtype,
+                     tile=(BLOCK_SIZE, BLOCK_SIZE), compress=DEFLATE_LEVEL,
+                     bigtiff=max_height * max_width * np.dtype(dtype).itemsize > BIGTIFF_BYTES)
+    del img
@@ -0,0 +1,122 @@
+"""
+Makes the TIF extraction safe to kill and restart.
+
+Every TIF is first written under the same name in a temporary directory next to
+the output directory, e.g., .tif.tmp/ for tif/, and only moved into place with
+os.replace once it is complete. As the temporary directory is on the same filesystem
+the move is atomic, so a file in the output directory is never half written.
+
+When a file is done, the worker that wrote it takes its byte size and crc32 checksum
+and the parent appends them to a journal next to the output directory, e.g.,
+.tif.journal.jsonl. A restart skips the files in the journal and redoes the rest.
+Files that were made before there was a journal are checked with their size and
+is_complete_tiff and added to it when they pass, their checksum is only taken when
+they are verified.
+"""
+import os
+import json
+import zlib
+
+from lib.utilities_manifest import is_complete_tiff
+
+CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def get_temp_path(output_path):
+    """
+    :param output_path: final path of the file
+    :return: path with the same file name in the temporary directory of the output directory
+    """
+    dir = os.path.dirname(os.path.abspath(output_path))
+    temp_dir = os.path.join(os.path.dirname(dir), f'.{os.path.basename(dir)}.tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, os.path.basename(output_path))
+
+
+def remove_file(filepath):
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def get_checksum(filepath):
+    crc = 0
+    with open(filepath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_BYTES), b''):
+            crc = zlib.crc32(chunk, crc)
+    return f'{crc:08x}'
+
+
+def get_file_record(filepath):
+    """
+    Run by the worker that wrote the file so the files are read back in parallel
+    :param filepath: path of the finished file
+    :return: tuple of path, size and checksum for CompletionJournal.record
+    """
+    return filepath, os.path.getsize(filepath), get_checksum(filepath)
+
+
+class CompletionJournal:
+    """
+    Append only record of the files that were written completely to a directory.
+    Only the parent process writes to it, the workers return the records of the files they finished.
+    """
+
+    def __init__(self, dir):
+        dir = os.path.normpath(dir)
+        self.path = os.path.join(os.path.dirname(dir), f'.{os.path.basename(dir)}.journal.jsonl')
+        self.entries = {}
+        try:
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # the last line of a killed run
+                    self.entries[entry['name']] = entry
+        except OSError:
+            pass
+
+    def record(self, filepath, size=None, crc32=None):
+        """
+        Adds a finished file with its size and checksum
+        :param filepath: path of the finished file
+        :param size: size in bytes, taken from the file when None
+        :param crc32: checksum from get_file_record, None when it is not known yet
+        """
+        if size is None:
+            size = os.path.getsize(filepath)
+        entry = {'name': os.path.basename(filepath), 'size': size, 'crc32': crc32}
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.entries[entry['name']] = entry
+
+    def is_done(self, filepath, verify=False):
+        """
+        Checks a file against the journal. Files made before the journal existed
+        are checked for completeness and recorded without reading the pixels.
+        :param filepath: path of the file
+        :param verify: True to also compare the checksum, this reads the whole file. A file
+            recorded without a checksum gets it recorded now
+        :return: True if the file does not need to be made again
+        """
+        if not os.path.exists(filepath):
+            return False
+        entry = self.entries.get(os.path.basename(filepath))
+        if entry is None:
+            if not is_complete_tiff(filepath):
+                return False
+            self.record(filepath, crc32=get_checksum(filepath) if verify else None)
+            return True
+        if entry['size'] != os.path.getsize(filepath):
+            return False
+        if verify:
+            crc32 = get_checksum(filepath)
+            if entry.get('crc32') is None:
+                self.record(filepath, entry['size'], crc32)
+            elif entry['crc32'] != crc32:
+                return False
+        return True
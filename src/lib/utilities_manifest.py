@@ -0,0 +1,247 @@
+"""
+Reads the width, height, data type and page count of TIFF and PNG files
+straight from the file header instead of running ImageMagick identify.
+Only a few hundred bytes are read per file.
+
+The results for a directory are kept in a manifest next to the directory,
+e.g., CH1/.full.manifest.json for CH1/full. It is not put inside the directory
+as the stages count the files in there. The manifest stores the name, size, mtime,
+width, height, dtype and page count of each file. Only the files whose size or
+mtime changed since the manifest was written get read again.
+"""
+import os
+import json
+import struct
+
+MANIFEST_VERSION = 1
+
+TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_SAMPLE_FORMAT = 339
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+SAMPLE_FORMATS = {1: 'uint', 2: 'int', 3: 'float'}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def read_tiff_tags(fh, byteorder, offset, bigtiff):
+    """
+    Reads the tags we care about from one IFD
+    :param fh: open file
+    :param byteorder: < or >
+    :param offset: file position of the IFD
+    :param bigtiff: True for BigTIFF
+    :return: tuple of dictionary of tag: first value and the offset of the next IFD
+    """
+    if bigtiff:
+        count_format, entry_format, offset_format, entry_size = 'Q', 'HHQ8s', 'Q', 20
+    else:
+        count_format, entry_format, offset_format, entry_size = 'H', 'HHI4s', 'I', 12
+    fh.seek(offset)
+    count_size = struct.calcsize(count_format)
+    count, = struct.unpack(byteorder + count_format, fh.read(count_size))
+    data = fh.read(count * entry_size + struct.calcsize(offset_format))
+    tags = {}
+    for i in range(count):
+        code, dtype, n, value = struct.unpack_from(byteorder + entry_format, data, i * entry_size)
+        if code not in (TIFF_IMAGE_WIDTH, TIFF_IMAGE_LENGTH, TIFF_BITS_PER_SAMPLE,
+                        TIFF_SAMPLES_PER_PIXEL, TIFF_SAMPLE_FORMAT) or dtype not in TIFF_TYPES:
+            continue
+        value_format = TIFF_TYPES[dtype]
+        # values that do not fit in the entry are stored elsewhere, they are all the same
+        # for the tags we read so the first one is enough
+        if struct.calcsize(value_format) * n > len(value):
+            pointer, = struct.unpack(byteorder + offset_format, value)
+            position = fh.tell()
+            fh.seek(pointer)
+            value = fh.read(struct.calcsize(value_format))
+            fh.seek(position)
+        tags[code], = struct.unpack_from(byteorder + value_format, value)
+    next_offset, = struct.unpack_from(byteorder + offset_format, data, count * entry_size)
+    return tags, next_offset
+
+
+def read_tiff_header(filepath):
+    with open(filepath, 'rb') as fh:
+        header = fh.read(16)
+        byteorder = {b'II': '<', b'MM': '>'}[header[:2]]
+        version, = struct.unpack_from(byteorder + 'H', header, 2)
+        bigtiff = version == 43
+        if bigtiff:
+            offset, = struct.unpack_from(byteorder + 'Q', header, 8)
+        elif version == 42:
+            offset, = struct.unpack_from(byteorder + 'I', header, 4)
+        else:
+            raise ValueError(f'{filepath} is not a TIFF file')
+
+        tags, offset = read_tiff_tags(fh, byteorder, offset, bigtiff)
+        pages = 1
+        while offset != 0:
+            _, offset = read_tiff_tags(fh, byteorder, offset, bigtiff)
+            pages += 1
+
+    bits = tags.get(TIFF_BITS_PER_SAMPLE, 1)
+    sample_format = SAMPLE_FORMATS.get(tags.get(TIFF_SAMPLE_FORMAT, 1), 'uint')
+    return {'width': tags[TIFF_IMAGE_WIDTH], 'height': tags[TIFF_IMAGE_LENGTH],
+            'dtype': f'{sample_format}{bits}', 'channels': tags.get(TIFF_SAMPLES_PER_PIXEL, 1),
+            'pages': pages}
+
+
+def read_tiff_segments(fh, byteorder, offset, bigtiff):
+    """
+    Reads every strip or tile offset and byte count of one IFD
+    :param fh: open file
+    :param byteorder: < or >
+    :param offset: file position of the IFD
+    :param bigtiff: True for BigTIFF
+    :return: tuple of list of offsets, list of byte counts and the offset of the next IFD
+    """
+    if bigtiff:
+        count_format, entry_format, offset_format, entry_size = 'Q', 'HHQ8s', 'Q', 20
+    else:
+        count_format, entry_format, offset_format, entry_size = 'H', 'HHI4s', 'I', 12
+    fh.seek(offset)
+    count, = struct.unpack(byteorder + count_format, fh.read(struct.calcsize(count_format)))
+    data = fh.read(count * entry_size + struct.calcsize(offset_format))
+    values = {}
+    for i in range(count):
+        code, dtype, n, value = struct.unpack_from(byteorder + entry_format, data, i * entry_size)
+        if code not in (TIFF_STRIP_OFFSETS, TIFF_STRIP_BYTE_COUNTS, TIFF_TILE_OFFSETS,
+                        TIFF_TILE_BYTE_COUNTS) or dtype not in TIFF_TYPES:
+            continue
+        value_format = f'{n}{TIFF_TYPES[dtype]}'
+        size = struct.calcsize(value_format)
+        if size > len(value):
+            pointer, = struct.unpack(byteorder + offset_format, value)
+            fh.seek(pointer)
+            value = fh.read(size)
+        values[code] = struct.unpack_from(byteorder + value_format, value)
+    next_offset, = struct.unpack_from(byteorder + offset_format, data, count * entry_size)
+    offsets = values.get(TIFF_STRIP_OFFSETS, values.get(TIFF_TILE_OFFSETS, ()))
+    byte_counts = values.get(TIFF_STRIP_BYTE_COUNTS, values.get(TIFF_TILE_BYTE_COUNTS, ()))
+    return offsets, byte_counts, next_offset
+
+
+def is_complete_tiff(filepath):
+    """
+    Checks that a TIFF was written to the end: the header and every IFD can be read
+    and every strip or tile lies inside the file. A file cut short by a killed
+    writer fails this check. The pixels are not decoded.
+    :param filepath: path of the TIFF
+    :return: True if the file is complete
+    """
+    try:
+        file_size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as fh:
+            header = fh.read(16)
+            byteorder = {b'II': '<', b'MM': '>'}[header[:2]]
+            version, = struct.unpack_from(byteorder + 'H', header, 2)
+            bigtiff = version == 43
+            if bigtiff:
+                offset, = struct.unpack_from(byteorder + 'Q', header, 8)
+            elif version == 42:
+                offset, = struct.unpack_from(byteorder + 'I', header, 4)
+            else:
+                return False
+            pages = 0
+            while offset != 0:
+                if offset >= file_size:
+                    return False
+                offsets, byte_counts, offset = read_tiff_segments(fh, byteorder, offset, bigtiff)
+                if len(offsets) == 0 or len(offsets) != len(byte_counts):
+                    return False
+                if max(o + n for o, n in zip(offsets, byte_counts)) > file_size:
+                    return False
+                pages += 1
+    except (OSError, KeyError, struct.error):
+        return False
+    return pages > 0
+
+
+def read_png_header(filepath):
+    with open(filepath, 'rb') as fh:
+        header = fh.read(29)
+    if header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        raise ValueError(f'{filepath} is not a PNG file')
+    width, height, bits, color_type = struct.unpack('>IIBB', header[16:26])
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    return {'width': width, 'height': height, 'dtype': f'uint{max(bits, 8)}',
+            'channels': channels, 'pages': 1}
+
+
+def read_image_header(filepath):
+    """
+    Gets the dimensions of a TIFF or PNG file without reading the pixels.
+    :param filepath: path of the image
+    :return: dictionary with width, height, dtype, channels and pages
+    """
+    with open(filepath, 'rb') as fh:
+        magic = fh.read(4)
+    if magic[:2] in (b'II', b'MM'):
+        return read_tiff_header(filepath)
+    if magic == PNG_SIGNATURE[:4]:
+        return read_png_header(filepath)
+    raise ValueError(f'{filepath} is not a TIFF or PNG file')
+
+
+def get_manifest_path(dir):
+    dir = os.path.normpath(dir)
+    return os.path.join(os.path.dirname(dir), f'.{os.path.basename(dir)}.manifest.json')
+
+
+def load_manifest(dir):
+    """
+    Gets the header information of every file in the directory. Files whose
+    size and mtime match the saved manifest are not read again.
+    :param dir: directory of images
+    :return: dictionary of file name: dictionary with size, mtime, width, height, dtype, channels, pages.
+        width and height are None for files that could not be read.
+    """
+    manifest_path = get_manifest_path(dir)
+    try:
+        with open(manifest_path) as fh:
+            saved = json.load(fh)
+        if saved.get('version') != MANIFEST_VERSION:
+            saved = {}
+    except (OSError, ValueError):
+        saved = {}
+    saved_files = saved.get('files', {})
+
+    files = {}
+    changed = False
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            record = saved_files.get(entry.name)
+            if record is not None and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns:
+                files[entry.name] = record
+                continue
+            record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                      'width': None, 'height': None, 'dtype': None, 'channels': None, 'pages': None}
+            try:
+                record.update(read_image_header(entry.path))
+            except (OSError, ValueError, KeyError, struct.error) as e:
+                print(f'Could not read the header of {entry.path} {e}')
+            files[entry.name] = record
+            changed = True
+
+    if changed or len(files) != len(saved_files):
+        save_manifest(manifest_path, files)
+    return files
+
+
+def save_manifest(manifest_path, files):
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as fh:
+            json.dump({'version': MANIFEST_VERSION, 'files': files}, fh)
+        os.replace(tmp_path, manifest_path)
+    except OSError as e:
+        print(f'Could not save {manifest_path} {e}')
@@ -14,6 +14,7 @@ import os
 #sys.path.append(PIPELINE_ROOT.as_posix())
 
 from lib.utilities_process import get_last_2d
+from lib.utilities_stats import get_masked_histograms, get_masked_strips, get_quantile
 from lib.GimpInterface import GimpInterface
 
 font = cv2.FONT_HERSHEY_SIMPLEX
@@ -273,7 +274,7 @@ def check_contour(contours, area, lc):
         return contours, lc
 
 
-def scaled(img, mask, scale=45000, epsilon=0.01):
+def scaled(img, mask, scale=45000, epsilon=0.01, stats=None):
     """
     This scales the image to the limit specified. You can get this value
     by looking at the combined histogram of the image stack. It is quite
@@ -282,9 +283,16 @@ def scaled(img, mask, scale=45000, epsilon=0.01):
     :param mask: binary mask file
     :param epsilon:
     :param limit: max value we wish to scale to
+    :param stats: cached statistics of the section from get_section_stats, optional
     :return: scaled image in 16bit format
     """
-    _max = np.quantile(img[mask > 10], 1 - epsilon) # gets almost the max value of img
+    # the quantile comes from the histogram of the tissue, same value as np.quantile without sorting
+    if stats is None and img.dtype.kind in 'ui':
+        stats = get_masked_histograms(get_masked_strips(img, mask), np.iinfo(img.dtype).max + 1)
+    if stats is not None:
+        _max = get_quantile(stats['above'], 1 - epsilon) # gets almost the max value of img
+    else:
+        _max = np.quantile(img[mask > 10], 1 - epsilon)
     # print('thr=%d, index=%d'%(vals[ind],index))
     if scale > 255:
         _range = 2 ** 16 - 1 # 16bit
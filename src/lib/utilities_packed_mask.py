@@ -0,0 +1,112 @@
+"""
+Compact storage for the binary tissue masks. A mask is 0 or 255, so one bit per pixel
+is enough. Only the bounding box of the tissue is stored, every row packed with
+np.packbits, after a small header:
+
+    magic (4 bytes), version, height, width, top, bottom, left, right (uint32 little endian)
+
+The packed rows are read with np.frombuffer so any range of rows can be unpacked
+without touching the others. A packed mask sits next to where the TIFF would be,
+e.g., masks/thumbnail_masked/000.pmask instead of 000.tif, and load_mask reads
+whichever one is there.
+"""
+import os
+import struct
+import cv2
+import numpy as np
+
+PACKED_MASK_EXTENSION = '.pmask'
+PACKED_MASK_MAGIC = b'PMSK'
+PACKED_MASK_VERSION = 1
+HEADER = struct.Struct('<4s7I')
+STRIP_ROWS = 2048
+
+
+def get_packed_path(maskfile):
+    """
+    :param maskfile: file path of the mask, e.g., .../000.tif
+    :return: file path of the packed mask, e.g., .../000.pmask
+    """
+    return os.path.splitext(maskfile)[0] + PACKED_MASK_EXTENSION
+
+
+def mask_exists(maskfile):
+    return os.path.exists(maskfile) or os.path.exists(get_packed_path(maskfile))
+
+
+def write_packed_mask(outpath, mask):
+    """
+    :param outpath: file path of the packed mask
+    :param mask: 2D array, anything above 0 is tissue
+    """
+    height, width = mask.shape
+    tissue = mask > 0
+    rows = np.flatnonzero(tissue.any(axis=1))
+    cols = np.flatnonzero(tissue.any(axis=0))
+    if len(rows) == 0:
+        top = bottom = left = right = 0
+    else:
+        top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    packed = np.packbits(tissue[top:bottom, left:right], axis=1)
+    with open(outpath, 'wb') as fh:
+        fh.write(HEADER.pack(PACKED_MASK_MAGIC, PACKED_MASK_VERSION, height, width, top, bottom, left, right))
+        fh.write(packed.tobytes())
+
+
+class PackedMask:
+    """
+    A packed mask that hands out its rows as 0/255 uint8 arrays
+    """
+
+    def __init__(self, maskfile):
+        with open(maskfile, 'rb') as fh:
+            data = fh.read()
+        magic, version, height, width, top, bottom, left, right = HEADER.unpack_from(data)
+        if magic != PACKED_MASK_MAGIC or version != PACKED_MASK_VERSION:
+            raise ValueError(f'{maskfile} is not a packed mask')
+        self.shape = (height, width)
+        self.bbox = (top, bottom, left, right)
+        row_bytes = -(-(right - left) // 8)
+        self.packed = np.frombuffer(data, dtype=np.uint8, offset=HEADER.size,
+                                    count=(bottom - top) * row_bytes).reshape(bottom - top, row_bytes)
+
+    def rows(self, start, stop, col0=0, col1=None):
+        """
+        :param col0: first column wanted
+        :param col1: column after the last one wanted, the width when None
+        :return: the mask rows start to stop and columns col0 to col1, 0 or 255. Only the
+            bytes of those columns are unpacked
+        """
+        height, width = self.shape
+        top, bottom, left, right = self.bbox
+        start, stop = max(start, 0), min(stop, height)
+        col0, col1 = max(col0, 0), width if col1 is None else min(col1, width)
+        out = np.zeros((max(stop - start, 0), max(col1 - col0, 0)), dtype=np.uint8)
+        r0, r1 = max(start, top), min(stop, bottom)
+        c0, c1 = max(col0, left), min(col1, right)
+        if r1 > r0 and c1 > c0:
+            first_byte = (c0 - left) // 8
+            last_byte = -(-(c1 - left) // 8)
+            bits = np.unpackbits(self.packed[r0 - top:r1 - top, first_byte:last_byte], axis=1)
+            offset = c0 - left - first_byte * 8
+            out[r0 - start:r1 - start, c0 - col0:c1 - col0] = bits[:, offset:offset + c1 - c0] * np.uint8(255)
+        return out
+
+    def strips(self, strip_rows=STRIP_ROWS):
+        for row in range(0, self.shape[0], strip_rows):
+            yield row, self.rows(row, row + strip_rows)
+
+    def full(self):
+        return self.rows(0, self.shape[0])
+
+
+def load_mask(maskfile):
+    """
+    Reads a mask whether it is an 8 bit image or a packed mask.
+    :param maskfile: file path of the mask, the .pmask next to it is used when it exists
+    :return: 2D uint8 array or None if there is no mask
+    """
+    packed_path = get_packed_path(maskfile)
+    if os.path.exists(packed_path):
+        return PackedMask(packed_path).full()
+    return cv2.imread(maskfile, cv2.IMREAD_GRAYSCALE)
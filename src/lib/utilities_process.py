@@ -1,8 +1,17 @@
 import os, sys, time
+import struct
 from subprocess import Popen, run, check_output
 from multiprocessing.pool import Pool
 from tqdm import tqdm
 import socket
+import errno
+import fcntl
+import shutil
+import psutil
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 PIPELINE_ROOT = Path('.').absolute().parent
 sys.path.append(PIPELINE_ROOT.as_posix())
@@ -11,6 +20,8 @@ from lib.file_location import FileLocationManager
 from lib.sqlcontroller import SqlController
 from sql_setup import QC_IS_DONE_ON_SLIDES_IN_WEB_ADMIN, CZI_FILES_ARE_CONVERTED_INTO_NUMBERED_TIFS_FOR_CHANNEL_1
 from lib.logger import get_logger
+from lib.utilities_manifest import read_image_header, load_manifest
+from lib.utilities_journal import CompletionJournal, get_temp_path, remove_file, get_file_record
 SCALING_FACTOR = 0.03125
 
 
@@ -31,7 +42,252 @@ def get_cpus():
         usecpus = cpus[hostname]
     return usecpus
 
+def get_memory_bounded_workers(njobs, task_memory, fraction=0.8):
+    """
+    Caps the number of processes so that the tasks running at the same time
+    fit in the memory that is available right now.
+    :param njobs: the most processes wanted
+    :param task_memory: peak bytes one task uses
+    :param fraction: fraction of the available memory to use
+    :return: number of processes to use, at least 1
+    """
+    available = psutil.virtual_memory().available * fraction
+    return max(1, min(njobs, int(available // max(task_memory, 1))))
+
+
+TASK_OVERHEAD = 256 * 1024 * 1024
+
+
+def get_task_memory(width, height, dtype=np.uint16, copies=1, overhead=TASK_OVERHEAD):
+    """
+    Rough peak memory of a task that works on a whole section
+    :param width: width of the section
+    :param height: height of the section
+    :param dtype: data type of the section
+    :param copies: how many arrays of the section size and data type the task holds at its peak
+    :param overhead: bytes of the worker process itself
+    :return: peak bytes
+    """
+    return int(int(width) * int(height) * np.dtype(dtype).itemsize * copies + overhead)
+
+
+def run_memory_bounded(worker, file_keys, memory, njobs, fraction=0.8):
+    """
+    Runs the tasks in a ProcessPoolExecutor but only starts a task when its peak memory
+    fits in what is left of the budget. The biggest tasks go first and when one ends,
+    the biggest waiting task that fits takes its place, so small sections run next to
+    the big ones. A worker that raises or gets killed is reported with its file_key
+    instead of being lost in executor.map.
+    :param worker: function that takes one file_key
+    :param file_keys: list of work items
+    :param memory: peak bytes of each work item, see get_task_memory
+    :param njobs: most processes to run at the same time
+    :param fraction: fraction of the available memory to use
+    :return: list of the results in the order of file_keys
+    """
+    budget = psutil.virtual_memory().available * fraction
+    waiting = sorted(range(len(file_keys)), key=lambda i: memory[i], reverse=True)
+    results = [None] * len(file_keys)
+    failures = []
+    running = {}
+    used = 0
+    broken = False
+    with ProcessPoolExecutor(max_workers=max(1, njobs)) as executor, tqdm(total=len(file_keys)) as progress:
+        while waiting or running:
+            while waiting and len(running) < njobs:
+                # a task bigger than the whole budget still runs, but on its own
+                fits = [i for i in waiting if used + memory[i] <= budget or not running]
+                if not fits:
+                    break
+                i = fits[0]
+                waiting.remove(i)
+                running[executor.submit(worker, file_keys[i])] = i
+                used += memory[i]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                used -= memory[i]
+                progress.update(1)
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool:
+                    print(f'A worker process died, probably out of memory, while working on {file_keys[i]}')
+                    failures.append(file_keys[i])
+                    broken = True
+                except Exception:
+                    print(f'Error in {file_keys[i]}')
+                    print(traceback.format_exc())
+                    failures.append(file_keys[i])
+            if broken:
+                # the executor cannot start anything else and the tasks still running die with it
+                failures.extend(file_keys[i] for i in running.values())
+                failures.extend(file_keys[i] for i in waiting)
+                break
+    if failures:
+        print('Tasks to run again:')
+        for file_key in failures:
+            print(file_key)
+        raise RuntimeError(f'{len(failures)} of {len(file_keys)} tasks failed or did not run')
+    return results
+
+
+CZI_MAGIC = b'ZISRAWFILE'
+
+
+def check_czi(czi_path, expected_size=None):
+    """
+    Cheap check of a czi before spending hours converting it: the file must start
+    with the ZISRAWFILE segment and have the size create_meta.py saw.
+    :param czi_path: path of the czi
+    :param expected_size: size in bytes from the slide table or None
+    :return: an error message or None if the file looks fine
+    """
+    try:
+        with open(czi_path, 'rb') as fh:
+            magic = fh.read(len(CZI_MAGIC))
+        size = os.path.getsize(czi_path)
+    except OSError as e:
+        return f'{czi_path} cannot be read {e}'
+    if magic != CZI_MAGIC:
+        return f'{czi_path} is not a czi file'
+    if expected_size and int(expected_size) != size:
+        return f'{czi_path} is {size} bytes, the slide table has {int(expected_size)}'
+    return None
+
+
+def schedule_czi_work(file_keys, czi_paths, sizes):
+    """
+    Checks the czi files and puts the work on the biggest files first, so one big
+    slide is not left running alone at the end while the other processes are idle.
+    :param file_keys: list of work items
+    :param czi_paths: list of the czi path of each work item
+    :param sizes: dictionary of czi file name: size in bytes from get_slide_file_sizes
+    :return: tuple of the sorted work items that passed the check and their sizes in bytes.
+        When a czi has several work items its size is split evenly between them
+    """
+    counts = {}
+    for czi_path in czi_paths:
+        counts[czi_path] = counts.get(czi_path, 0) + 1
+    errors = {}
+    for czi_path in counts:
+        errors[czi_path] = check_czi(czi_path, sizes.get(os.path.basename(czi_path)))
+        if errors[czi_path] is not None:
+            print(errors[czi_path])
+
+    work = []
+    for file_key, czi_path in zip(file_keys, czi_paths):
+        if errors[czi_path] is not None:
+            continue
+        size = sizes.get(os.path.basename(czi_path)) or os.path.getsize(czi_path)
+        work.append((size / counts[czi_path], size, file_key))
+    work.sort(key=lambda w: w[1], reverse=True)
+    return [w[2] for w in work], [w[0] for w in work]
+
+
+def run_scheduled(worker, file_keys, weights, njobs):
+    """
+    Runs the work in the order given, one item at a time per process, and shows
+    the progress in bytes so the expected time left follows the real work left.
+    :param worker: function that takes one work item
+    :param file_keys: list of work items
+    :param weights: size in bytes of each work item
+    :param njobs: number of processes
+    :return: iterator of the results as they finish
+    """
+    with Pool(njobs) as p, tqdm(total=sum(weights), unit='B', unit_scale=True) as progress:
+        for i, result in p.imap_unordered(run_indexed, [(worker, i, file_key) for i, file_key in enumerate(file_keys)], chunksize=1):
+            progress.update(weights[i])
+            yield result
+
+
+def run_indexed(task):
+    worker, i, file_key = task
+    return i, worker(file_key)
+
+
+def convert_tif(file_key):
+    """
+    Runs bfconvert into a temporary file and moves it to the output path
+    only when bfconvert finished without an error. This is the worker used by the pool.
+    file_key is a tuple of the following:
+        :param input_path: file path of the czi
+        :param output_path: file path of the tif
+        :param scene_index: bioformats series
+        :param channel_index: 0 based channel
+    :return: tuple of the output path, its size and checksum for the journal or None if it failed
+    """
+    input_path, output_path, scene_index, channel_index = file_key
+    temp_path = get_temp_path(output_path)
+    remove_file(temp_path)
+    cmd = ['/usr/local/share/bftools/bfconvert', '-bigtiff', '-separate', '-series', str(scene_index),
+           '-channel', str(channel_index), '-nooverwrite', input_path, temp_path]
+    proc = run(cmd, capture_output=True)
+    if proc.returncode != 0 or not os.path.exists(temp_path):
+        print(f'bfconvert failed on {output_path} {proc.stderr.decode(errors="replace")[-1000:]}')
+        remove_file(temp_path)
+        return None
+    os.replace(temp_path, output_path)
+    return get_file_record(output_path)
+
+
+FICLONE = 0x40049409
+STAGE_MODES = ['hardlink', 'reflink', 'symlink', 'copy']
+
+
+def reflink(src, dst):
+    """
+    Makes dst share the blocks of src on filesystems with copy on write
+    (btrfs, xfs with reflink=1). Raises OSError where that is not supported.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def stage_file(src, dst, mode='hardlink'):
+    """
+    Puts src at dst without copying the data when possible.
+    hardlink and reflink fall back to a copy when they are not possible,
+    e.g., src and dst are on different filesystems.
+    :param src: existing file
+    :param dst: path to create
+    :param mode: one of hardlink, reflink, symlink or copy
+    :return: the mode that was used in the end
+    """
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return mode
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return mode
+        if mode == 'reflink':
+            reflink(src, dst)
+            return mode
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+                           errno.EINVAL, errno.EMLINK):
+            raise
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
 def get_image_size(filepath):
+    """
+    Reads the width and height from the TIFF or PNG header. Anything
+    else still goes through ImageMagick identify.
+    :param filepath: path of the image
+    :return: tuple of width, height
+    """
+    try:
+        header = read_image_header(filepath)
+        return header['width'], header['height']
+    except (ValueError, KeyError, struct.error):
+        pass
     result_parts = str(check_output(["identify", filepath]))
     results = result_parts.split()
     width, height = results[2].split('x')
@@ -81,20 +337,24 @@ def test_dir(animal, dir, downsample=True, same_size=False):
     sqlController = SqlController(animal)
     section_count = sqlController.get_section_count(animal)
     try:
-        files = sorted(os.listdir(dir))
-    except:
+        manifest = load_manifest(dir)
+    except OSError:
         return f'{dir} does not exist'
-        
+    files = sorted(manifest)
+
     if section_count == 0:
         section_count = len(files)
     widths = set()
     heights = set()
     for f in files:
         filepath = os.path.join(dir, f)
-        width, height = get_image_size(filepath)
+        width = manifest[f]['width']
+        height = manifest[f]['height']
+        if width is None:
+            width, height = get_image_size(filepath)
         widths.add(int(width))
         heights.add(int(height))
-        size = os.path.getsize(filepath)
+        size = manifest[f]['size']
         if size < min_size:
             error += f"{size} is less than min: {min_size} {filepath} \n"
     # picked 100 as an arbitrary number. the min file count is usually around 380 or so
@@ -126,16 +386,21 @@ def get_last_2d(data):
 
 
 
-def make_tifs(animal, channel, njobs):
+def make_tifs(animal, channel, njobs, verify=False):
     """
     This method will:
         1. Fetch the sections from the database
         2. Yank the tif out of the czi file according to the index and channel with the bioformats tool.
         3. Then updates the database with updated meta information
+    Each tif is written to a temporary file and moved into place when complete.
+    Finished tifs are recorded in a journal with their size and checksum so a rerun
+    only redoes the ones that failed. The czi files are checked first and the
+    biggest ones are started first.
     Args:
         animal: the prep id of the animal
         channel: the channel of the stack to process
         njobs: number of jobs for parallel computing
+        verify: True to compare the checksums of the finished tifs, this reads every tif
         compression: default is no compression so we can create jp2 files for CSHL. The files get
         compressed using LZW when running create_preps.py
 
@@ -153,23 +418,89 @@ def make_tifs(animal, channel, njobs):
     sqlController.set_task(animal, QC_IS_DONE_ON_SLIDES_IN_WEB_ADMIN)
     sqlController.set_task(animal, CZI_FILES_ARE_CONVERTED_INTO_NUMBERED_TIFS_FOR_CHANNEL_1)
 
-    commands = []
+    journal = CompletionJournal(OUTPUT)
+    file_keys = []
+    czi_paths = []
     for section in sections:
         input_path = os.path.join(INPUT, section.czi_file)
         output_path = os.path.join(OUTPUT, section.file_name)
-        cmd = ['/usr/local/share/bftools/bfconvert', '-bigtiff', '-separate', '-series', str(section.scene_index),
-                '-channel', str(section.channel_index),  '-nooverwrite', input_path, output_path]
 
         if not os.path.exists(input_path):
             continue
 
-        if os.path.exists(output_path):
+        if journal.is_done(output_path, verify):
             continue
 
-        commands.append(cmd)
+        file_keys.append((input_path, output_path, section.scene_index, section.channel_index))
+        czi_paths.append(input_path)
 
-    with Pool(njobs) as p:
-        p.map(workernoshell, commands)
+    file_keys, weights = schedule_czi_work(file_keys, czi_paths, sqlController.get_slide_file_sizes())
+    print(f'Working on {len(file_keys)} tifs with {njobs} cpus, biggest czi files first')
+    for result in run_scheduled(convert_tif, file_keys, weights, njobs):
+        if result is not None:
+            journal.record(*result)
+
+
+def extract_tifs(animal, njobs, verify=False, fused=False):
+    """
+    In process replacement for make_tifs. Each czi file is opened once and all
+    the scenes and channels wanted from it are written in one pass, instead of
+    one bfconvert run per scene and channel.
+    With fused, the thumbnail of every tif goes in tif_thumbnail with the same
+    file name and the channel 1 web pngs in www/scene, both made from the scene
+    just written. make_low_resolution then links those thumbnails instead of
+    reading the full resolution tifs again.
+    Args:
+        animal: the prep id of the animal
+        njobs: number of czi files to work on at the same time
+        verify: True to compare the checksums of the finished tifs, this reads every tif
+        fused: True to also make the thumbnails and the web pngs
+
+    Returns:
+        nothing
+    """
+    # czifile is only needed here, not by every script that imports this module
+    from lib.utilities_czi import extract_czi
+    fileLocationManager = FileLocationManager(animal)
+    sqlController = SqlController(animal)
+    INPUT = fileLocationManager.czi
+    OUTPUT = fileLocationManager.tif
+    os.makedirs(OUTPUT, exist_ok=True)
+    sqlController.set_task(animal, QC_IS_DONE_ON_SLIDES_IN_WEB_ADMIN)
+    sqlController.set_task(animal, CZI_FILES_ARE_CONVERTED_INTO_NUMBERED_TIFS_FOR_CHANNEL_1)
+
+    THUMBNAILS = fileLocationManager.tif_thumbnail
+    SCENES = os.path.join(fileLocationManager.thumbnail_web, 'scene')
+    if fused:
+        os.makedirs(THUMBNAILS, exist_ok=True)
+        os.makedirs(SCENES, exist_ok=True)
+
+    journal = CompletionJournal(OUTPUT)
+    czi_outputs = {}
+    for channel in [1, 2, 3]:
+        sections = sqlController.get_distinct_section_filenames(animal, channel)
+        for section in sections:
+            input_path = os.path.join(INPUT, section.czi_file)
+            output_path = os.path.join(OUTPUT, section.file_name)
+            if not os.path.exists(input_path):
+                continue
+            if journal.is_done(output_path, verify):
+                continue
+            thumbnail_path = None
+            png_path = None
+            if fused:
+                thumbnail_path = os.path.join(THUMBNAILS, section.file_name)
+                if channel == 1:
+                    png_path = os.path.join(SCENES, section.file_name.replace('tif', 'png'))
+            czi_outputs.setdefault(input_path, []).append(
+                (section.scene_index, section.channel_index, output_path, thumbnail_path, png_path))
+
+    file_keys = [(input_path, outputs, SCALING_FACTOR) for input_path, outputs in czi_outputs.items()]
+    file_keys, weights = schedule_czi_work(file_keys, list(czi_outputs), sqlController.get_slide_file_sizes())
+    print(f'Working on {len(file_keys)} czi files with {njobs} cpus, biggest first')
+    for written in run_scheduled(extract_czi, file_keys, weights, njobs):
+        for result in written:
+            journal.record(*result)
 
 
 def make_scenes(animal):
@@ -199,6 +530,56 @@ def make_scenes(animal):
         p.map(workernoshell, convert_commands)
 
 
+def make_thumbnails_from_czi(animal, channel, njobs):
+    """
+    Creates the CHX/thumbnail files and, for channel 1, the www/scene pngs straight
+    from the pyramid levels stored in the czi files. The full resolution tifs
+    are not read at all.
+    Args:
+        animal: the prep id of the animal
+        channel: the channel of the stack to process
+        njobs: number of czi files to work on at the same time
+
+    Returns:
+        nothing
+    """
+    from lib.utilities_czi import make_czi_thumbnails
+    fileLocationManager = FileLocationManager(animal)
+    sqlController = SqlController(animal)
+    INPUT = fileLocationManager.czi
+    OUTPUT = os.path.join(fileLocationManager.prep, f'CH{channel}', 'thumbnail')
+    SCENES = os.path.join(fileLocationManager.thumbnail_web, 'scene')
+    os.makedirs(OUTPUT, exist_ok=True)
+    os.makedirs(SCENES, exist_ok=True)
+
+    thumbnails = {}
+    sections = sqlController.get_sections(animal, channel)
+    for section_number, section in enumerate(sections):
+        input_path = os.path.join(INPUT, section.czi_file)
+        output_path = os.path.join(OUTPUT, str(section_number).zfill(3) + '.tif')
+        if not os.path.exists(input_path):
+            continue
+        key = (input_path, section.scene_index, section.channel_index)
+        paths, png_path = thumbnails.get(key, ([], None))
+        if not os.path.exists(output_path):
+            paths.append(output_path)
+        png = section.file_name.replace('tif', 'png')
+        if channel == 1 and not os.path.exists(os.path.join(SCENES, png)):
+            png_path = os.path.join(SCENES, png)
+        thumbnails[key] = (paths, png_path)
+
+    czi_outputs = {}
+    for (input_path, scene_index, channel_index), (paths, png_path) in thumbnails.items():
+        if len(paths) == 0 and png_path is None:
+            continue
+        czi_outputs.setdefault(input_path, []).append((scene_index, channel_index, paths, png_path))
+
+    file_keys = [(input_path, outputs, SCALING_FACTOR) for input_path, outputs in czi_outputs.items()]
+    print(f'Working on {len(file_keys)} czi files with {njobs} cpus')
+    with Pool(njobs) as p:
+        p.map(make_czi_thumbnails, file_keys)
+
+
 def make_tif(animal, tif_id, file_id, testing=False):
     fileLocationManager = FileLocationManager(animal)
     sqlController = SqlController(animal)
@@ -212,15 +593,16 @@ def make_tif(animal, tif_id, file_id, testing=False):
     tif_file = os.path.join(OUTPUT, section.file_name)
     if not os.path.exists(czi_file) and not testing:
         return 0
-    if os.path.exists(tif_file):
+    journal = CompletionJournal(OUTPUT)
+    if journal.is_done(tif_file):
         return 1
 
     if testing:
-        command = ['touch', tif_file]
+        run(['touch', tif_file])
     else:
-        command = ['/usr/local/share/bftools/bfconvert', '-bigtiff', '-separate',
-                                  '-series', str(tif.scene_index), '-channel', str(tif.channel-1), '-nooverwrite', czi_file, tif_file]
-    run(command)
+        result = convert_tif((czi_file, tif_file, tif.scene_index, tif.channel - 1))
+        if result is not None:
+            journal.record(*result)
 
     end = time.time()
     if os.path.exists(tif_file):
@@ -16,6 +16,8 @@
 """
 
 import os
+import traceback
+import cv2
 import numpy as np
 from matplotlib import pyplot as plt
 import SimpleITK as sitk
@@ -101,6 +103,167 @@ def command_iteration(method):
 
 
 
+PREALIGN_SIZE = 256
+POLAR_ANGLES = 360
+MIN_RESPONSE = 0.05
+# residual shift in thumbnail pixels after the prealignment that gets the full iteration budget
+FULL_RESIDUAL = 8.0
+MIN_ITERATIONS = 50
+MAX_ITERATIONS = 700
+MIN_RESOLUTIONS = 2
+MAX_RESOLUTIONS = 6
+
+
+def get_rotation(angle, center):
+    """
+    :return: 3x3 matrix rotating (x, y) points by angle radians about center
+    """
+    R = np.array([[np.cos(angle), -np.sin(angle)],
+                  [np.sin(angle), np.cos(angle)]])
+    return np.vstack([np.column_stack([R, center - np.dot(R, center)]), [0, 0, 1]])
+
+
+def get_translation(x, y):
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+
+
+def downsample(img, size=PREALIGN_SIZE):
+    """
+    :return: tuple of the image area averaged so its longest side is at most size,
+        and the 3x3 matrix from its (x, y) pixels to the pixels of the image
+    """
+    height, width = img.shape
+    factor = max(1.0, max(height, width) / size)
+    dsize = (max(1, int(round(width / factor))), max(1, int(round(height / factor))))
+    small = cv2.resize(np.asarray(img, dtype=np.float32), dsize, interpolation=cv2.INTER_AREA)
+    fx, fy = width / dsize[0], height / dsize[1]
+    # pixel centres: x = (x_small + 0.5) * fx - 0.5
+    return small, np.array([[fx, 0, (fx - 1) / 2], [0, fy, (fy - 1) / 2], [0, 0, 1]])
+
+
+def get_polar_spectrum(img):
+    """
+    High passed magnitude spectrum of the image padded to a square, in log-polar
+    coordinates with one row per degree. A rotation of the image is a shift of the rows.
+    """
+    n = max(img.shape)
+    square = np.zeros((n, n), dtype=np.float32)
+    top, left = (n - img.shape[0]) // 2, (n - img.shape[1]) // 2
+    square[top:top + img.shape[0], left:left + img.shape[1]] = img
+    square *= cv2.createHanningWindow((n, n), cv2.CV_32F)
+    frequencies = np.fft.fftshift(np.fft.fftfreq(n))
+    high_pass = 1 - np.cos(np.pi * frequencies)[:, None] * np.cos(np.pi * frequencies)[None, :]
+    spectrum = (np.abs(np.fft.fftshift(np.fft.fft2(square))) * high_pass).astype(np.float32)
+    return cv2.warpPolar(spectrum, (n // 2, POLAR_ANGLES), (n / 2, n / 2), n / 2, cv2.WARP_POLAR_LOG)
+
+
+def prealign(fixed, moving):
+    """
+    Estimates the rotation and translation between two masked thumbnails with phase
+    correlation. The rotation comes from the log-polar magnitude spectra, which do not
+    depend on the translation. The spectra cannot tell a rotation from the same rotation
+    plus 180 degrees, so both are tried and the translation with the highest peak wins.
+    :param fixed: 2D array
+    :param moving: 2D array of the same shape
+    :return: tuple of the 3x3 matrix from the (x, y) pixels of fixed to the pixels of moving,
+        and the response of the translation peak, around 0 when nothing matched
+    """
+    small_fixed, S = downsample(fixed)
+    small_moving, _ = downsample(moving)
+    height, width = small_fixed.shape
+    (_, rows), _ = cv2.phaseCorrelate(get_polar_spectrum(small_fixed), get_polar_spectrum(small_moving))
+    angle = rows * 2 * np.pi / POLAR_ANGLES
+    center = np.array([(width - 1) / 2, (height - 1) / 2])
+    window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+    best = None
+    for angle in [angle, angle + np.pi]:
+        R = get_rotation(angle, center)
+        rotated = cv2.warpAffine(small_moving, R[:2], (width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        # rotated(p) = fixed(p - shift)
+        (x, y), response = cv2.phaseCorrelate(small_fixed, rotated, window)
+        if best is None or response > best[1]:
+            best = (R @ get_translation(x, y), response)
+    M, response = best
+    return S @ M @ np.linalg.inv(S), response
+
+
+def get_residual(fixed, resampled):
+    """
+    :return: tuple of the shift left between the fixed image and the prealigned
+        moving image, in pixels of the fixed image, and the response of the peak
+    """
+    small_fixed, S = downsample(fixed)
+    small_resampled, _ = downsample(resampled)
+    window = cv2.createHanningWindow(small_fixed.shape[::-1], cv2.CV_32F)
+    (x, y), response = cv2.phaseCorrelate(small_fixed, small_resampled, window)
+    return float(np.hypot(x * S[0, 0], y * S[1, 1])), response
+
+
+def get_iteration_budget(residual):
+    """
+    Pairs that are already close after the prealignment only need a few iterations at a few
+    resolutions, the budget grows with the residual up to the settings used without prealignment.
+    :param residual: shift left after the prealignment in thumbnail pixels
+    :return: tuple of maximum number of iterations and number of resolutions
+    """
+    fraction = min(1.0, residual / FULL_RESIDUAL)
+    iterations = int(round(MIN_ITERATIONS + fraction * (MAX_ITERATIONS - MIN_ITERATIONS)))
+    resolutions = int(round(MIN_RESOLUTIONS + fraction * (MAX_RESOLUTIONS - MIN_RESOLUTIONS)))
+    return iterations, resolutions
+
+
+def get_physical_matrix(image):
+    """
+    :return: 3x3 matrix from the (x, y) pixels of the SimpleITK image to its physical points
+    """
+    spacing, origin = image.GetSpacing(), image.GetOrigin()
+    return np.array([[spacing[0], 0, origin[0]], [0, spacing[1], origin[1]], [0, 0, 1]])
+
+
+def get_parameter_matrix(parameter_map):
+    """
+    :return: the Euler transform of an elastix parameter map as a 3x3 matrix from fixed to moving physical points
+    """
+    rotation, xshift, yshift = [float(v) for v in parameter_map['TransformParameters']]
+    center = np.array([float(v) for v in parameter_map['CenterOfRotationPoint']])
+    T = get_rotation(rotation, center)
+    T[:2, 2] += (xshift, yshift)
+    return T
+
+
+def register_prealigned(fixed, moving, threads=None):
+    """
+    Rigid registration that starts from the phase correlation estimate. The moving image is
+    resampled once with the estimate, elastix only finds what is left, with an iteration
+    budget that depends on how much is left, and the two transforms are composed.
+    When the phase correlation found nothing, this is the plain register_images.
+    :param fixed: SimpleITK image
+    :param moving: SimpleITK image on the same grid
+    :param threads: number of ITK threads, None for the ITK default
+    :return: rotation, xshift and yshift about the elastix center of rotation, like register_images
+    """
+    fixed_array = sitk.GetArrayViewFromImage(fixed)
+    M, response = prealign(fixed_array, sitk.GetArrayViewFromImage(moving))
+    if response < MIN_RESPONSE:
+        return register_images(fixed, moving, threads)['TransformParameters']
+    P = get_physical_matrix(fixed)
+    M = P @ M @ np.linalg.inv(P)
+    initial = sitk.AffineTransform(2)
+    initial.SetMatrix(M[:2, :2].ravel().tolist())
+    initial.SetTranslation(M[:2, 2].tolist())
+    resampled = sitk.Resample(moving, fixed, initial, sitk.sitkLinear, 0.0)
+    residual, _ = get_residual(fixed_array, sitk.GetArrayViewFromImage(resampled))
+    iterations, resolutions = get_iteration_budget(residual)
+    parameter_map = register_images(fixed, resampled, threads, iterations, resolutions)
+
+    T = M @ get_parameter_matrix(parameter_map)
+    center = np.array([float(v) for v in parameter_map['CenterOfRotationPoint']])
+    rotation = np.arctan2(T[1, 0], T[0, 0])
+    R = T[:2, :2]
+    xshift, yshift = T[:2, 2] - center + np.dot(R, center)
+    return rotation, xshift, yshift
+
+
 def register_test(INPUT, fixed_index, moving_index):
     pixelType = sitk.sitkFloat32
     fixed_file = os.path.join(INPUT, f'{fixed_index}.tif')
@@ -149,11 +312,77 @@ def register_simple(INPUT, fixed_index, moving_index):
     moving_file = os.path.join(INPUT, f'{moving_index}.tif')
     fixed = sitk.ReadImage(fixed_file, pixelType)
     moving = sitk.ReadImage(moving_file, pixelType)
+    return register_images(fixed, moving)['TransformParameters']
 
+
+def register_chunk(file_key):
+    """
+    Registers every section of a contiguous run of sections to the one before it.
+    Each section is read once, the moving image of one pair is the fixed image of the next.
+    file_key is a tuple of the following:
+        :param INPUT: directory of the cleaned thumbnails
+        :param indexes: consecutive section names without extension, the first one is only fixed
+        :param threads: number of ITK threads for this process
+        :param prealign: True to start elastix from the phase correlation estimate, see register_prealigned
+    :return: list of (moving index, rotation, xshift, yshift) of the pairs that were registered,
+        a pair that fails is reported and left out
+    """
+    INPUT, indexes, threads, prealign = file_key
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+    pixelType = sitk.sitkFloat32
+    rows = []
+    fixed = None
+    fixed_index = indexes[0]
+    for moving_index in indexes[1:]:
+        moving = None
+        try:
+            if fixed is None:
+                fixed = sitk.ReadImage(os.path.join(INPUT, f'{fixed_index}.tif'), pixelType)
+            moving = sitk.ReadImage(os.path.join(INPUT, f'{moving_index}.tif'), pixelType)
+            if prealign:
+                rotation, xshift, yshift = register_prealigned(fixed, moving, threads)
+            else:
+                rotation, xshift, yshift = register_images(fixed, moving, threads)['TransformParameters']
+            rows.append((moving_index, float(rotation), float(xshift), float(yshift)))
+        except Exception:
+            print(f'Could not register {moving_index} to {fixed_index}')
+            print(traceback.format_exc())
+        fixed, fixed_index = moving, moving_index
+    return rows
+
+
+def register_images(fixed, moving, threads=None, iterations=MAX_ITERATIONS, resolutions=MAX_RESOLUTIONS):
+    """
+    Rigid registration of the moving image to the fixed image with elastix
+    :param fixed: SimpleITK image
+    :param moving: SimpleITK image
+    :param threads: number of ITK threads, None for the ITK default
+    :param iterations: maximum number of iterations in each resolution
+    :param resolutions: number of resolutions
+    :return: the elastix transform parameter map, TransformParameters has the
+        rotation, xshift and yshift as strings
+    """
     elastixImageFilter = sitk.ElastixImageFilter()
+    if threads is not None:
+        elastixImageFilter.SetNumberOfThreads(threads)
     elastixImageFilter.SetFixedImage(fixed)
     elastixImageFilter.SetMovingImage(moving)
-    rigid_params = elastixImageFilter.GetDefaultParameterMap("rigid")
+    elastixImageFilter.SetParameterMap(get_rigid_parameter_map(iterations, resolutions))
+    elastixImageFilter.LogToConsoleOff()
+
+
+    elastixImageFilter.Execute()
+    return elastixImageFilter.GetTransformParameterMap()[0]
+
+
+def get_rigid_parameter_map(iterations=MAX_ITERATIONS, resolutions=MAX_RESOLUTIONS):
+    """
+    The elastix settings of the section to section registration
+    :param iterations: maximum number of iterations in each resolution
+    :param resolutions: number of resolutions
+    :return: elastix parameter map
+    """
+    rigid_params = sitk.GetDefaultParameterMap("rigid")
 
 
     rigid_params['AutomaticTransformInitializationMethod']=['GeometricalCenter']
@@ -266,7 +495,7 @@ def register_simple(INPUT, fixed_index, moving_index):
     ## The number of resolutions. 1 Is only enough if the expected
     ## deformations are small. 3 or 4 mostly works fine. For large
     ## images and large deformations, 5 or 6 may even be useful.
-    rigid_params['NumberOfResolutions']=['6']
+    rigid_params['NumberOfResolutions']=[str(resolutions)]
     ##(FinalGridSpacingInVoxels 8.0 8.0)
     ##(GridSpacingSchedule 6.0 6.0 4.0 4.0 2.5 2.5 1.0 1.0)
 
@@ -290,7 +519,7 @@ def register_simple(INPUT, fixed_index, moving_index):
     ## 80 good results, 7 minutes on basalis with 4 jobs
     ## 200 good results except for 1st couple were not aligned, 12 minutes
     ## 500 is best, including first sections, basalis took 21 minutes
-    rigid_params['MaximumNumberOfIterations']=['700']
+    rigid_params['MaximumNumberOfIterations']=[str(iterations)]
 
     ## The step size of the optimizer, in mm. By default the voxel size is used.
     ## which usually works well. In case of unusual high-resolution images
@@ -344,10 +573,5 @@ def register_simple(INPUT, fixed_index, moving_index):
 
 
 
-    elastixImageFilter.SetParameterMap(rigid_params)
-    elastixImageFilter.LogToConsoleOff()
-
-
-    elastixImageFilter.Execute()
-    return elastixImageFilter.GetTransformParameterMap()[0]["TransformParameters"]
+    return rigid_params
 
@@ -0,0 +1,136 @@
+"""
+Intensity statistics of the sections from masked histograms. The images are
+integers, so one bincount gives the exact histogram and any quantile can be read
+from it without sorting the pixels.
+
+The statistics of a section are three histograms: the values under the mask above
+the threshold used by scaled(), the values under the rest of the mask, and the
+number of pixels outside the mask. They are cached per section in a directory next
+to the image directory, e.g., CH1/.thumbnail.stats/000.tif.npz, and are used again
+as long as the size and mtime of the image and of the mask do not change.
+"""
+import os
+import cv2
+import numpy as np
+
+from lib.utilities_packed_mask import load_mask, get_packed_path
+from lib.utilities_thumbnail import get_row_strips
+
+MASK_THRESHOLD = 10
+# rows of the image histogrammed at a time, get_masked_histograms makes int64 copies of them
+STATS_STRIP_BYTES = 8 * 1024 * 1024
+
+
+def get_quantile(hist, q):
+    """
+    Same as np.quantile(values, q) with the default linear interpolation, from the
+    histogram of the values instead of the values.
+    :param hist: counts of every integer value
+    :param q: quantile between 0 and 1
+    :return: the quantile as a float
+    """
+    n = int(hist.sum())
+    if n == 0:
+        raise ValueError('There are no values under the mask')
+    index = q * (n - 1)
+    below = int(np.floor(index))
+    above = min(below + 1, n - 1)
+    weight_above = index - below
+    cumulative = np.cumsum(hist)
+    value_below = np.searchsorted(cumulative, below, side='right')
+    value_above = np.searchsorted(cumulative, above, side='right')
+    return value_below * (1 - weight_above) + value_above * weight_above
+
+
+def get_masked_histograms(strips, n_values=2 ** 16, threshold=MASK_THRESHOLD):
+    """
+    Histograms of an image under its mask in one pass.
+    :param strips: iterator of (image rows, mask rows), a whole image is one strip
+    :param n_values: number of bins, 2**16 for 16 bit images
+    :param threshold: mask values above this are counted in above
+    :return: dictionary of above, below (histograms of the values where the mask is above the
+        threshold and where it is between 1 and the threshold) and outside (pixels where the mask is 0)
+    """
+    stats = {'above': np.zeros(n_values, dtype=np.int64), 'below': np.zeros(n_values, dtype=np.int64),
+             'outside': 0}
+    for img, mask in strips:
+        img = img.astype(np.int64, copy=False)
+        # one bincount: bin value for above, n_values + value for below, 2 * n_values for outside
+        codes = np.where(mask > threshold, img, np.where(mask > 0, img + n_values, 2 * n_values))
+        counts = np.bincount(codes.ravel(), minlength=2 * n_values + 1)
+        stats['above'] += counts[:n_values]
+        stats['below'] += counts[n_values:2 * n_values]
+        stats['outside'] += int(counts[2 * n_values])
+    return stats
+
+
+def get_masked_strips(img, mask, strip_bytes=STATS_STRIP_BYTES):
+    """
+    :param img: whole image
+    :param mask: mask of the same height
+    :return: iterator of (image rows, mask rows) for get_masked_histograms
+    """
+    for row, rows in get_row_strips(img, strip_bytes):
+        yield rows, mask[row:row + rows.shape[0]]
+
+
+def get_masked_image_histogram(stats):
+    """
+    :param stats: dictionary from get_masked_histograms
+    :return: histogram of cv2.bitwise_and(img, img, mask=mask), the pixels outside the mask are 0
+    """
+    hist = stats['above'] + stats['below']
+    hist[0] += stats['outside']
+    return hist
+
+
+def get_stats_path(filepath):
+    dir = os.path.dirname(os.path.abspath(filepath))
+    stats_dir = os.path.join(os.path.dirname(dir), f'.{os.path.basename(dir)}.stats')
+    return os.path.join(stats_dir, f'{os.path.basename(filepath)}.npz')
+
+
+def get_file_key(filepath):
+    stat = os.stat(filepath)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def get_section_stats(filepath, maskfile, threshold=MASK_THRESHOLD, img=None, mask=None):
+    """
+    Gets the statistics of one section, from the cache when the image and mask did not change.
+    :param filepath: path of the image
+    :param maskfile: path of the mask, 8 bit or packed
+    :param threshold: mask threshold, see get_masked_histograms
+    :param img: the image already read from filepath, read when it is needed and None
+    :param mask: the mask already read from maskfile, read when it is needed and None
+    :return: dictionary from get_masked_histograms or None if the image or mask cannot be read
+    """
+    packed_path = get_packed_path(maskfile)
+    mask_key_path = packed_path if os.path.exists(packed_path) else maskfile
+    try:
+        key = np.concatenate([get_file_key(filepath), get_file_key(mask_key_path), [threshold]])
+    except OSError:
+        return None
+    stats_path = get_stats_path(filepath)
+    try:
+        with np.load(stats_path) as cached:
+            if np.array_equal(cached['key'], key):
+                return {'above': cached['above'], 'below': cached['below'], 'outside': int(cached['outside'])}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if img is None:
+        img = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+    if mask is None:
+        mask = load_mask(maskfile)
+    if img is None or mask is None or img.shape[:2] != mask.shape[:2] or img.dtype.kind not in 'ui':
+        return None
+    stats = get_masked_histograms(get_masked_strips(img, mask), np.iinfo(img.dtype).max + 1, threshold)
+    try:
+        os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+        tmp_path = f'{stats_path}.{os.getpid()}.npz'
+        np.savez(tmp_path, key=key, above=stats['above'], below=stats['below'], outside=stats['outside'])
+        os.replace(tmp_path, stats_path)
+    except OSError as e:
+        print(f'Could not save {stats_path} {e}')
+    return stats
@@ -0,0 +1,163 @@
+"""
+Creates the downsampled thumbnails in process. The full resolution TIFF is read
+a strip at a time, either straight from a memory map when the TIFF is uncompressed
+(as bfconvert writes them) or by decoding one strip at a time. Each strip is area
+averaged into the thumbnail, so the whole full resolution image is never in memory.
+"""
+import cv2
+import numpy as np
+import tifffile
+
+STRIP_BYTES = 64 * 1024 * 1024
+
+
+def get_thumbnail_size(width, height, scaling_factor):
+    """
+    Same rounding as ImageMagick convert -resize 3.125%
+    :param width: full resolution width
+    :param height: full resolution height
+    :param scaling_factor: e.g., 0.03125
+    :return: tuple of width, height of the thumbnail
+    """
+    return max(int(width * scaling_factor + 0.5), 1), max(int(height * scaling_factor + 0.5), 1)
+
+
+def contrast_stretch(img, black=0.02, white=0.01):
+    """
+    Same as ImageMagick -normalize which is -contrast-stretch 2%x1%
+    :param img: image we are working on
+    :param black: fraction of pixels that become black
+    :param white: fraction of pixels that become white
+    :return: stretched image in the same data type
+    """
+    _range = np.iinfo(img.dtype).max
+    lo, hi = np.quantile(img, [black, 1 - white])
+    if hi <= lo:
+        return img
+    stretched = (img.astype(np.float32) - lo) * (_range / (hi - lo))
+    return np.clip(stretched, 0, _range).astype(img.dtype)
+
+
+def get_tif_shape(filepath):
+    """
+    :param filepath: path of the TIFF
+    :return: tuple of height, width, samples and dtype of the first page
+    """
+    with tifffile.TiffFile(filepath) as tif:
+        page = tif.pages[0]
+        height, width = page.imagelength, page.imagewidth
+        return height, width, page.samplesperpixel, page.dtype
+
+
+def read_strips(filepath, strip_bytes=STRIP_BYTES):
+    """
+    Reads the first page of a TIFF a band of rows at a time.
+    :param filepath: path of the TIFF
+    :param strip_bytes: about how many bytes to hand out at a time for uncompressed files
+    :return: iterator of (row, strip) where strip has the shape (rows, width) or (rows, width, samples)
+    """
+    with tifffile.TiffFile(filepath) as tif:
+        page = tif.pages[0]
+        memmappable = page.is_memmappable
+        tiled = page.is_tiled
+        if not memmappable and not tiled:
+            for segment, index, shape in page.segments():
+                rows = segment.reshape(shape[-3], shape[-2], shape[-1])
+                if rows.shape[-1] == 1:
+                    rows = rows[:, :, 0]
+                yield index[2], rows
+            return
+        if tiled:
+            # tiles cannot be streamed by rows, decode them to a temporary memory map on disk
+            data = page.asarray(out='memmap')
+
+    if memmappable:
+        data = tifffile.memmap(filepath, page=0, mode='r')
+    yield from get_row_strips(data, strip_bytes)
+    del data
+
+
+def get_row_strips(data, strip_bytes=STRIP_BYTES):
+    """
+    Hands out an array or memory map a band of rows at a time.
+    :param data: 2D or 3D array
+    :param strip_bytes: about how many bytes to hand out at a time
+    :return: iterator of (row, strip) like read_strips
+    """
+    rows = max(1, strip_bytes // (data.strides[0]))
+    for row in range(0, data.shape[0], rows):
+        yield row, np.asarray(data[row:row + rows])
+
+
+def get_bin_starts(size, out_size):
+    """
+    Source index where each output pixel starts. Every output pixel averages
+    the source pixels up to the start of the next one.
+    """
+    return (np.arange(out_size, dtype=np.int64) * size) // out_size
+
+
+def area_downsample(strips, height, width, out_height, out_width, samples=1, dtype=np.uint16):
+    """
+    Area averages a stream of row strips into a small image.
+    :param strips: iterator of (row, strip) like read_strips
+    :param height: height of the full image
+    :param width: width of the full image
+    :param out_height: height of the result
+    :param out_width: width of the result
+    :param samples: samples per pixel
+    :param dtype: data type of the result
+    :return: downsampled image
+    """
+    dtype = np.dtype(dtype)
+    sum_dtype = np.float64 if dtype.kind == 'f' else np.uint64
+    row_starts = get_bin_starts(height, out_height)
+    col_starts = get_bin_starts(width, out_width)
+    row_counts = np.diff(np.append(row_starts, height))
+    col_counts = np.diff(np.append(col_starts, width))
+    shape = (out_height, out_width) if samples == 1 else (out_height, out_width, samples)
+    total = np.zeros(shape, dtype=sum_dtype)
+
+    for row, strip in strips:
+        col_sums = np.add.reduceat(strip, col_starts, axis=1, dtype=sum_dtype)
+        out_rows = np.searchsorted(row_starts, np.arange(row, row + strip.shape[0]), side='right') - 1
+        groups = np.concatenate(([0], np.flatnonzero(np.diff(out_rows)) + 1))
+        total[out_rows[groups]] += np.add.reduceat(col_sums, groups, axis=0)
+        del col_sums
+
+    counts = np.outer(row_counts, col_counts)
+    if samples > 1:
+        counts = counts[:, :, None]
+    averaged = total / counts
+    if dtype.kind != 'f':
+        averaged = np.rint(averaged)
+    return averaged.astype(dtype)
+
+
+def get_downsample_memory(filepath, scaling_factor, strip_bytes=STRIP_BYTES):
+    """
+    Rough peak memory of downsample_tif for one file: a strip, its column sums
+    and the sums of the thumbnail.
+    """
+    height, width, samples, dtype = get_tif_shape(filepath)
+    out_width, out_height = get_thumbnail_size(width, height, scaling_factor)
+    strip = max(strip_bytes, width * samples * dtype.itemsize)
+    return 2 * strip + out_width * out_height * samples * 8 * 3
+
+
+def downsample_tif(file_key):
+    """
+    Creates the thumbnail of one full resolution TIFF. This is the worker used by the pool.
+    file_key is a tuple of the following:
+        :param infile: file path of full resolution TIFF
+        :param outpath: file path of the thumbnail to write, opencv uses LZW compression
+        :param scaling_factor: e.g., 0.03125
+    :return: nothing. we write the image to disk
+    """
+    infile, outpath, scaling_factor = file_key
+    height, width, samples, dtype = get_tif_shape(infile)
+    out_width, out_height = get_thumbnail_size(width, height, scaling_factor)
+    img = area_downsample(read_strips(infile), height, width, out_height, out_width, samples, dtype)
+    if samples == 3:
+        img = img[:, :, ::-1] # opencv writes BGR
+    cv2.imwrite(outpath, img)
@@ -0,0 +1,85 @@
+"""
+Content addressed cache of the section to section transforms. A pair of sections is
+known by the sha1 of the fixed image, of the moving image and of the registration
+settings, not by the file names. After slide QC replaces, reorders or replicates
+scenes, only the pairs whose images changed are registered again and the others
+are taken from the cache whatever their file names are now.
+
+The transforms of simple_registration.py are kept in elastix/transforms.json and
+the elastix parameter files of create_elastix.py in elastix/.cache/, one per pair key.
+Every pair directory of create_elastix.py also records the key it was made for.
+"""
+import os
+import json
+import hashlib
+
+CHUNK_BYTES = 16 * 1024 * 1024
+PAIR_KEY_FILE = '.pair_key'
+
+
+def get_file_hash(filepath):
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_BYTES), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_parameter_hash(parameters):
+    """
+    :param parameters: contents of an elastix parameter file, or a dictionary of settings
+    :return: sha1 of the settings
+    """
+    if not isinstance(parameters, (str, bytes)):
+        parameters = json.dumps(parameters, sort_keys=True)
+    if isinstance(parameters, str):
+        parameters = parameters.encode()
+    return hashlib.sha1(parameters).hexdigest()
+
+
+def get_pair_key(fixed_hash, moving_hash, parameter_hash):
+    return hashlib.sha1(f'{fixed_hash} {moving_hash} {parameter_hash}'.encode()).hexdigest()
+
+
+class TransformCache:
+    """
+    Dictionary of pair key: (rotation, xshift, yshift) saved as json in a directory
+    """
+
+    def __init__(self, dir):
+        self.path = os.path.join(dir, 'transforms.json')
+        try:
+            with open(self.path) as fh:
+                self.transforms = {key: tuple(value) for key, value in json.load(fh).items()}
+        except (OSError, ValueError):
+            self.transforms = {}
+
+    def get(self, key):
+        return self.transforms.get(key)
+
+    def put(self, key, transform):
+        self.transforms[key] = tuple(float(v) for v in transform)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.transforms, fh, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def read_pair_key(dir):
+    """
+    :param dir: elastix output directory of a pair
+    :return: the key of the pair the directory was made for, None if it is not known
+    """
+    try:
+        with open(os.path.join(dir, PAIR_KEY_FILE)) as fh:
+            return fh.read().strip()
+    except OSError:
+        return None
+
+
+def write_pair_key(dir, key):
+    with open(os.path.join(dir, PAIR_KEY_FILE), 'w') as fh:
+        fh.write(key)
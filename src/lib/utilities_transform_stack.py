@@ -0,0 +1,129 @@
+"""
+The section to anchor transforms of an animal as one (n, 3, 3) array.
+
+elastix gives every section the rigid transform to the section before it. The anchor is
+the middle section, the sections after it are taken back to it with the products of the
+transforms from the anchor up to them and the sections before it with the products of
+the inverses. Both are running products, so every section costs one 3x3 product from its
+neighbour instead of the whole chain from the anchor again.
+
+All the rows of the animal are read in one query. The stack is in the order of the
+sorted file names of CH1/thumbnail_cleaned, the same as the dictionaries of parse_elastix.
+"""
+import os
+import struct
+import numpy as np
+from skimage import io
+
+from lib.file_location import FileLocationManager
+from lib.utilities_manifest import read_image_header
+from model.elastix_transformation import ElastixTransformation
+from sql_setup import session
+
+# the translations of the transforms are in thumbnail pixels
+FULL_RESOLUTION_FACTOR = 32
+
+
+def load_elastix_rows(animal):
+    """
+    :param animal: prep_id of the animal
+    :return: dictionary of section: (rotation, xshift, yshift), the newest row is taken
+        when a section has more than one
+    """
+    rows = session.query(ElastixTransformation.section, ElastixTransformation.rotation,
+                         ElastixTransformation.xshift, ElastixTransformation.yshift)\
+        .filter(ElastixTransformation.prep_id == animal).order_by(ElastixTransformation.id).all()
+    return {section: (rotation, xshift, yshift) for section, rotation, xshift, yshift in rows}
+
+
+def get_rigid_transforms(parameters, center):
+    """
+    create_elastix_transformation for many sections at once
+    :param parameters: (n, 3) array of rotation, xshift, yshift
+    :param center: (x, y) center of rotation
+    :return: (n, 3, 3) array of transforms
+    """
+    parameters = np.asarray(parameters, dtype=np.float64).reshape(-1, 3)
+    cos, sin = np.cos(parameters[:, 0]), np.sin(parameters[:, 0])
+    transforms = np.zeros((len(parameters), 3, 3))
+    transforms[:, 0, 0], transforms[:, 0, 1] = cos, -sin
+    transforms[:, 1, 0], transforms[:, 1, 1] = sin, cos
+    transforms[:, :2, 2] = center + parameters[:, 1:] - transforms[:, :2, :2] @ center
+    transforms[:, 2, 2] = 1
+    return transforms
+
+
+def invert_rigid_transforms(transforms):
+    """
+    :param transforms: (n, 3, 3) array of rotations and translations
+    :return: (n, 3, 3) array of their inverses, the transposed rotation and the translation taken back
+    """
+    inverses = np.zeros_like(transforms)
+    rotations = np.swapaxes(transforms[:, :2, :2], 1, 2)
+    inverses[:, :2, :2] = rotations
+    inverses[:, :2, 2] = -(rotations @ transforms[:, :2, 2, None])[:, :, 0]
+    inverses[:, 2, 2] = 1
+    return inverses
+
+
+def get_anchor_transforms(to_previous, midpoint):
+    """
+    :param to_previous: (n, 3, 3) array, to_previous[i] takes section i to section i - 1,
+        to_previous[0] is not used
+    :param midpoint: position of the anchor section
+    :return: (n, 3, 3) array of the transforms of every section to the anchor
+    """
+    to_anchor = np.empty_like(to_previous)
+    to_anchor[midpoint] = np.eye(3)
+    for i in range(midpoint + 1, len(to_previous)):
+        to_anchor[i] = to_previous[i] @ to_anchor[i - 1]
+    if midpoint > 0:
+        to_next = invert_rigid_transforms(to_previous[1:midpoint + 1])
+        for i in range(midpoint - 1, -1, -1):
+            to_anchor[i] = to_next[i] @ to_anchor[i + 1]
+    return to_anchor
+
+
+def scale_translations(transforms, downsample):
+    """
+    :param transforms: (n, 3, 3) array of transforms for the thumbnails
+    :param downsample: either true for thumbnails, false for full resolution images
+    :return: (n, 3, 3) array of the transforms for the resolution
+    """
+    transforms = np.array(transforms, dtype=np.float64)
+    if not downsample:
+        transforms[:, :2, 2] *= FULL_RESOLUTION_FACTOR
+    return transforms
+
+
+def get_center(filepath):
+    try:
+        header = read_image_header(filepath)
+        width, height = header['width'], header['height']
+    except (OSError, ValueError, KeyError, struct.error):
+        img = io.imread(filepath, img_num=0)
+        height, width = img.shape[:2]
+    return np.array([width, height]) / 2
+
+
+def load_transform_stack(animal):
+    """
+    :param animal: prep_id of the animal
+    :return: tuple of the sorted file names and the (n, 3, 3) array of their transforms to the anchor
+    """
+    fileLocationManager = FileLocationManager(animal)
+    INPUT = os.path.join(fileLocationManager.prep, 'CH1', 'thumbnail_cleaned')
+    files = sorted(os.listdir(INPUT))
+    midpoint = len(files) // 2
+    center = get_center(os.path.join(INPUT, files[midpoint]))
+
+    rows = load_elastix_rows(animal)
+    parameters = np.zeros((len(files), 3))
+    for i in range(1, len(files)):
+        moving_index = os.path.splitext(files[i])[0]
+        if moving_index in rows:
+            parameters[i] = rows[moving_index]
+        else:
+            print(f'No value for {animal} {moving_index}')
+    to_previous = get_rigid_transforms(parameters, center)
+    return files, get_anchor_transforms(to_previous, midpoint)
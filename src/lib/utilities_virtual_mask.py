@@ -0,0 +1,72 @@
+"""
+Full resolution masks made on demand from the thumbnail masks. Instead of writing
+a full size copy of every mask to masks/full_masked, the thumbnail mask is kept
+and the rows wanted are upsampled with nearest neighbour when they are needed.
+"""
+import numpy as np
+
+from lib.utilities_packed_mask import load_mask
+
+STRIP_ROWS = 2048
+
+
+def get_nearest_index(out_size, in_size):
+    """
+    Source index of every output pixel, taken at the pixel centers
+    :param out_size: size of the full resolution axis
+    :param in_size: size of the thumbnail axis
+    :return: integer array of length out_size
+    """
+    index = ((np.arange(out_size, dtype=np.float64) + 0.5) * (in_size / out_size)).astype(np.int64)
+    return np.minimum(index, in_size - 1)
+
+
+class VirtualMask:
+    """
+    A thumbnail mask that looks like a full resolution mask
+    """
+
+    def __init__(self, maskfile, width, height):
+        """
+        :param maskfile: file path of the thumbnail mask, 8 bit or packed
+        :param width: width of the full resolution image
+        :param height: height of the full resolution image
+        """
+        self.thumbnail = load_mask(maskfile)
+        if self.thumbnail is None:
+            raise OSError(f'Mask {maskfile} does not exist')
+        self.shape = (height, width)
+        self.row_index = get_nearest_index(height, self.thumbnail.shape[0])
+        self.col_index = get_nearest_index(width, self.thumbnail.shape[1])
+
+    def rows(self, start, stop, col0=0, col1=None):
+        """
+        :param col0: first column wanted
+        :param col1: column after the last one wanted, the width when None
+        :return: the full resolution mask rows start to stop and columns col0 to col1,
+            only those columns are upsampled
+        """
+        return self.thumbnail.take(self.row_index[start:stop], axis=0).take(self.col_index[col0:col1], axis=1)
+
+    def strips(self, strip_rows=STRIP_ROWS):
+        """
+        :return: iterator of (row, mask rows) covering the whole mask
+        """
+        for row in range(0, self.shape[0], strip_rows):
+            yield row, self.rows(row, row + strip_rows)
+
+    def full(self):
+        return self.rows(0, self.shape[0])
+
+
+def apply_mask(img, mask):
+    """
+    Same as cv2.bitwise_and(img, img, mask=mask) but done in place a strip at a time,
+    so the full resolution mask is never all in memory.
+    :param img: full resolution image, changed in place
+    :param mask: VirtualMask of the same size
+    :return: the masked image
+    """
+    for row, strip in mask.strips():
+        img[row:row + strip.shape[0]][strip == 0] = 0
+    return img
@@ -1,31 +1,88 @@
 import argparse
 
+from multiprocessing.pool import Pool
 from tqdm import tqdm
 import os
 
-from lib.utilities_registration import register_simple
+from lib.file_location import FileLocationManager
+from lib.utilities_registration import register_chunk, get_rigid_parameter_map
+from lib.utilities_transform_cache import TransformCache, get_file_hash, get_parameter_hash, get_pair_key
 from lib.sqlcontroller import SqlController
 
-def create_elastix(animal):
 
+def get_runs(positions, size):
+    """
+    Splits the positions of the moving sections to register into runs of consecutive
+    sections, at most size pairs each.
+    :param positions: sorted positions of the moving sections, each is registered to the one before
+    :return: list of lists of positions, the first one of each list is only the fixed section
+    """
+    runs = []
+    for position in positions:
+        if len(runs) > 0 and runs[-1][-1] == position - 1 and len(runs[-1]) <= size:
+            runs[-1].append(position)
+        else:
+            runs.append([position - 1, position])
+    return runs
+
+
+def create_elastix(animal, njobs, prealign=False):
+    """
+    Registers every section to the one before it. The sections are split in contiguous
+    runs, one task each, so every thumbnail is read once except where two runs meet.
+    The cpus are shared between the processes and the ITK threads in each of them.
+    Pairs whose images and settings did not change since they were registered are taken
+    from the transform cache, and only the database rows that changed are written again.
+    :param animal: prep_id of the animal
+    :param njobs: number of processes
+    :param prealign: True to start every pair from a phase correlation estimate and
+        give elastix only the iterations the pair needs
+    """
     DIR = f'/net/birdstore/Active_Atlas_Data/data_root/pipeline_data/{animal}/preps'
     INPUT = os.path.join(DIR, 'CH1', 'thumbnail_cleaned')
     sqlController = SqlController(animal)
+    fileLocationManager = FileLocationManager(animal)
     files = sorted(os.listdir(INPUT))
-    sqlController.clear_elastix(animal)
+    indexes = [os.path.splitext(file)[0] for file in files]
+
+    cache = TransformCache(fileLocationManager.elastix_dir)
+    parameters = {key: list(value) for key, value in get_rigid_parameter_map().items()}
+    parameter_hash = get_parameter_hash({'parameters': parameters, 'prealign': prealign})
+    hashes = [get_file_hash(os.path.join(INPUT, file)) for file in tqdm(files)]
+    keys = {indexes[i]: get_pair_key(hashes[i - 1], hashes[i], parameter_hash) for i in range(1, len(files))}
+    positions = [i for i in range(1, len(files)) if cache.get(keys[indexes[i]]) is None]
+    print(f'{len(files) - 1 - len(positions)} pairs are in the cache, registering {len(positions)}')
 
-    for i in tqdm(range(1, len(files))):
-        fixed_index = os.path.splitext(files[i-1])[0]
-        moving_index = os.path.splitext(files[i])[0]        
-        rotation, xshift, yshift = register_simple(INPUT, fixed_index, moving_index)
-        sqlController.add_elastix_row(animal, moving_index, rotation, xshift, yshift)
+    threads = max(1, (os.cpu_count() or 1) // njobs)
+    # a few runs per process so the processes finish together, each run shares its first section with the one before
+    size = max(2, -(-len(positions) // (njobs * 4)))
+    file_keys = [(INPUT, [indexes[i] for i in run], threads, prealign) for run in get_runs(positions, size)]
+    # the pairs registered so far are kept even when the run is stopped
+    try:
+        with Pool(njobs) as p:
+            for chunk_rows in tqdm(p.imap_unordered(register_chunk, file_keys), total=len(file_keys)):
+                for moving_index, rotation, xshift, yshift in chunk_rows:
+                    cache.put(keys[moving_index], (rotation, xshift, yshift))
+    finally:
+        cache.save()
+
+    rows = []
+    for moving_index, key in sorted(keys.items()):
+        if cache.get(key) is None:
+            print(f'{moving_index} was not registered, run again to finish it')
+        else:
+            rows.append((moving_index, *cache.get(key)))
+    sqlController.update_elastix_rows(animal, rows)
 
 
 if __name__ == '__main__':
     # Parsing argument
     parser = argparse.ArgumentParser(description='Work on Animal')
     parser.add_argument('--animal', help='Enter the animal', required=True)
+    parser.add_argument('--njobs', help='How many processes to spawn', default=4, required=False)
+    parser.add_argument('--prealign', help='Enter true to start elastix from a phase correlation estimate', required=False, default='false')
     args = parser.parse_args()
     animal = args.animal
-    create_elastix(animal)
-
+    njobs = int(args.njobs)
+    prealign = bool({'true': True, 'false': False}[str(args.prealign).lower()])
+    create_elastix(animal, njobs, prealign)